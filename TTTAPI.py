@@ -5,42 +5,122 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 
+import collections
+import re
+import time
+
 import endpoints
-from protorpc import remote, messages
+from protorpc import remote, messages, protojson
 from google.appengine.api import memcache, mail
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from models import (
     User, 
     Game, 
     Score,
+    GameCounter,
+    ImportLog,
+    COMPUTER_NAME,
+    MEMCACHE_RANKINGS
 )
 from forms import (
     StringMessage, 
     NewGameForm, 
     GameForm, 
     GameForms, 
+    GameDeltaForm,
+    GameStatsForm,
+    HeadToHeadForm,
+    HintForm,
+    ImportGamesForm,
     MakeMoveForm,
+    MakeMovesForm,
+    RatingForm,
     ScoreForms, 
+    UserForm,
     UserForms
 )
 from utils import (
     get_by_urlsafe,
-    check_winner, 
-    check_full
+    get_key_by_urlsafe,
+    fetch_page,
+    DEFAULT_PAGE_SIZE
+)
+from mailer import queue_turn_emails_async
+from analytics import PlayerRating, HeadToHead
+from instrumentation import instrumented
+import ai
+from board import (
+    Board,
+    X,
+    O,
+    MIN_BOARD_SIZE,
+    MAX_BOARD_SIZE,
+    default_win_length
 )
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+GAME_DELTA_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    since_version=messages.IntegerField(2),)
+WAIT_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    since_version=messages.IntegerField(2),
+    timeout=messages.IntegerField(3),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
+IMPORT_GAMES_REQUEST = endpoints.ResourceContainer(ImportGamesForm)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2),)
+HEAD_TO_HEAD_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    opponent_name=messages.StringField(2),)
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    email=messages.StringField(2),
+    page_size=messages.IntegerField(3),
+    cursor=messages.StringField(4),)
+
+MEMCACHE_USER_RANK = 'RANK:%s'
+RANKINGS_CACHE_TIME = 60
+# Long polls stay well inside the 60s request deadline
+DEFAULT_WAIT_SECONDS = 20
+MAX_WAIT_SECONDS = 25
+# Backoff between memcache polls, in seconds
+WAIT_POLL_FIRST = 0.05
+WAIT_POLL_MAX = 1.0
+# Most moves make_moves applies, enough to fill the largest board
+MAX_MOVES_PER_REQUEST = MAX_BOARD_SIZE * MAX_BOARD_SIZE
+MAX_IMPORT_GAMES = 500
+IMPORT_BATCH_SIZE = 200
+# Import ids name the imported Games and Scores
+IMPORT_ID = re.compile(r'^[A-Za-z0-9_-]{1,100}$')
+# Times the computer's replies are searched again when a game moves on
+# while they are searched
+REPLY_ATTEMPTS = 3
+# Seconds every search for the computer's replies in one request may take
+# together, well inside the request and transaction deadlines
+REPLY_SEARCH_SECONDS = 10.0
+
 
-MEMCACHE_GAMES_PLAYED = 'GAMES_PLAYED'
+class _RepliesNeeded(Exception):
+    """Raised in a move transaction when the computer must reply but no
+    replies were searched for the game's current state. Holds that state"""
+
+    def __init__(self, version, board, mark):
+        Exception.__init__(self)
+        self.version = version
+        self.board = board
+        self.mark = mark
 
 
 @endpoints.api(name='tictactoe', version='v1')
@@ -52,16 +132,19 @@ class TicTacToeApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.get_current_user(request.user_name):
+        if (request.user_name == COMPUTER_NAME or
+                User.get_current_user(request.user_name)):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
         if not mail.is_email_valid(request.user_name):
             raise endpoints.ConflictException(
                     'Not a good email address')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        if not User.create(request.user_name, request.email):
+            raise endpoints.ConflictException(
+                    'A User with that name already exists!')
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -70,33 +153,52 @@ class TicTacToeApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        player_x = User.get_current_user(request.player_x)
-        player_o = User.get_current_user(request.player_o)
+        # Both players are fetched in parallel
+        player_x = User.get_current_user_async(request.player_x)
+        if request.vs_computer:
+            player_o = User.get_computer_async()
+        else:
+            player_o = User.get_current_user_async(request.player_o)
+        player_x, player_o = player_x.get_result(), player_o.get_result()
         if not (player_x and player_o):
-            wrong_user = player_x if not player_x else player_o
+            wrong_user = request.player_o if player_x else request.player_x
             raise endpoints.NotFoundException(
-              'User % does not exists!' % wrong_user.name)
-# Board size
-        boardSize = 3
-        if not boardSize: 
-            raise endpoints.BadRequestException('Board Size not valid')
-  
-        game = Game.new_game(player_x.key, player_o.key, boardSize)
+              'User %s does not exists!' % wrong_user)
+        boardSize, win_length = self._board_settings(request.boardSize,
+                                                     request.win_length)
+        game = Game.new_game(player_x.key, player_o.key, boardSize, win_length)
+        form = game.to_form()
+        game.cache_form(form)
 
-        return game.to_form()
+        return form
+
+    @staticmethod
+    def _board_settings(boardSize, win_length):
+        """Returns the board size and number in a row needed to win, with
+        their defaults filled in. Raises BadRequestException if invalid"""
+        boardSize = boardSize or 3
+        if not MIN_BOARD_SIZE <= boardSize <= MAX_BOARD_SIZE:
+            raise endpoints.BadRequestException('Board Size not valid')
+        win_length = win_length or default_win_length(boardSize)
+        if not MIN_BOARD_SIZE <= win_length <= boardSize:
+            raise endpoints.BadRequestException('Win length not valid')
+        return boardSize, win_length
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @instrumented
     def cancel_game(self, request):
         """Cancel a game."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game and not game.game_over:
             game.key.delete()
+            game.uncache()
             return StringMessage(message='Game with key: {} deleted'.format(request.urlsafe_game_key))
         elif game.game_over:
             raise endpoints.BadRequestException('Game over!')
@@ -108,141 +210,494 @@ class TicTacToeApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Return to current game"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return to current game. Served from the cached form, without a
+        datastore read, until the game changes"""
+        form = Game.cached_form(request.urlsafe_game_key)
+        if form:
+            return form
+        game = Game.get_game(request.urlsafe_game_key)
         if game:
-            return game.to_form()
+            form = game.to_form()
+            game.cache_form(form)
+            return form
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GAME_DELTA_REQUEST,
+                      response_message=GameDeltaForm,
+                      path='game/{urlsafe_game_key}/delta',
+                      name='get_game_delta',
+                      http_method='GET')
+    @instrumented
+    def get_game_delta(self, request):
+        """Return the moves played since a version of the game. Answers
+        'not modified' from memcache alone while the game is unchanged"""
+        since_version = request.since_version or 0
+        if since_version < 0:
+            raise endpoints.BadRequestException('since_version is negative')
+        version = Game.cached_version(request.urlsafe_game_key)
+        if version is not None and version <= since_version:
+            return GameDeltaForm(version=version, modified=False)
+        game = Game.get_game(request.urlsafe_game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        game.cache_version()
+        return game.to_delta_form(since_version)
+
+    @endpoints.method(request_message=WAIT_REQUEST,
+                      response_message=GameDeltaForm,
+                      path='game/{urlsafe_game_key}/wait',
+                      name='wait_for_turn',
+                      http_method='GET')
+    @instrumented
+    def wait_for_turn(self, request):
+        """Wait up to timeout seconds for a game to move past since_version.
+        Returns the new moves as soon as make_move commits, or a not modified
+        reply on timeout. Waiting only polls the game's memcache version"""
+        since_version = request.since_version or 0
+        if since_version < 0:
+            raise endpoints.BadRequestException('since_version is negative')
+        timeout = min(request.timeout or DEFAULT_WAIT_SECONDS,
+                      MAX_WAIT_SECONDS)
+        deadline = time.time() + timeout
+        delay = WAIT_POLL_FIRST
+        checked_datastore = False
+        while True:
+            version = Game.cached_version(request.urlsafe_game_key)
+            if version is None and not checked_datastore:
+                # Evicted from memcache: read the game once to publish it
+                checked_datastore = True
+                game = Game.get_game(request.urlsafe_game_key)
+                if not game:
+                    raise endpoints.NotFoundException('Game not found!')
+                game.cache_version()
+                version = game.version
+            if version is not None and version > since_version:
+                game = Game.get_game(request.urlsafe_game_key)
+                if not game:
+                    raise endpoints.NotFoundException('Game not found!')
+                return game.to_delta_form(since_version)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return GameDeltaForm(version=since_version, modified=False)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, WAIT_POLL_MAX)
+
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+# The User is looked up while the transaction reads the game
+        user = User.get_current_user_async(request.user_name)
+        game = self._make_moves(game_key, [(user, request.move)]).get_result()
+        return self._publish_move(game).get_result()
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    def make_moves(self, request):
+        """Makes a list of moves in order. The whole list is checked against
+        the board and committed at once, or not at all"""
+        if not 0 < len(request.moves) <= MAX_MOVES_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                'Send between 1 and %d moves' % MAX_MOVES_PER_REQUEST)
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        users = dict((name, User.get_current_user_async(name)) for name in
+                     set(move.user_name for move in request.moves))
+        moves = [(users[move.user_name], move.move) for move in request.moves]
+        game = self._make_moves(game_key, moves).get_result()
+        return self._publish_move(game).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def _make_moves(game_key, moves):
+        """Applies (User future, move) pairs in order and commits them. In
+        games against the computer, its replies are searched outside the
+        transaction, so the search neither holds the transaction open nor
+        runs again when it retries"""
+        replies = None
+        deadline = time.time() + REPLY_SEARCH_SECONDS
+        for _ in range(REPLY_ATTEMPTS):
+            try:
+                game = yield TicTacToeApi._commit_moves(game_key, moves,
+                                                        replies)
+            except _RepliesNeeded, e:
+                replies = (e.version, TicTacToeApi._search_replies(
+                    e.board, e.mark, [move for _, move in moves], deadline))
+            else:
+                raise ndb.Return(game)
+        raise endpoints.ConflictException(
+            'The game changed while the computer was thinking, try again')
+
+    @staticmethod
+    def _search_replies(board, mark, moves, deadline):
+        """Returns the computer's replies to moves played by mark, searched
+        on a copy of the board. Stops at the first move that is invalid or
+        ends the game. The time left until deadline is shared between the
+        replies still to search, each getting at most the AI's usual
+        budget"""
+        board = Board(board.size, board.win_length, board.x, board.o)
+        reply_mark = O if mark == X else X
+        replies = []
+        for i, move in enumerate(moves):
+            if not (0 <= move < len(board) and board.is_empty(move)):
+                break
+            if board.play(move, mark) or board.is_full():
+                break
+            budget = max(deadline - time.time(), 0) / (len(moves) - i)
+            reply = ai.best_move(board, reply_mark,
+                                 min(budget, ai.DEFAULT_TIME_BUDGET))
+            replies.append(reply)
+            if board.play(reply, reply_mark) or board.is_full():
+                break
+        return replies
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _commit_moves(game_key, moves, replies):
+        """Applies (User future, move) pairs in order and commits the game,
+        plus the Score and the players if it ends the game, in one
+        transaction. replies is (version, cells) with the computer's replies
+        when they were searched for the game at that version. A concurrent
+        move on the same game makes this one retry and see the new state"""
+        game, users = yield (game_key.get_async(),
+                             [user for user, _ in moves])
         if not game:
             raise endpoints.NotFoundException('Game not found')
-        if game.game_over:
-            raise endpoints.NotFoundException('Game already over!')
+        start = (game.version, Board(game.engine.size, game.engine.win_length,
+                                     game.engine.x, game.engine.o),
+                 game.next_mark)
+        if replies and replies[0] == game.version:
+            replies = list(replies[1])
+        else:
+            replies = None
+        entities = [game]
+        for user, (_, move) in zip(users, moves):
+            if not user:
+                raise endpoints.NotFoundException('User not found')
+            if game.game_over:
+                raise endpoints.NotFoundException('Game already over!')
 
 # Prevent a user from playing twice back to back
-        user = User.get_current_user(request.user_name)
-        if user.key != game.nextMove:
-            raise endpoints.BadRequestException('It\'s not your turn!')
-        x = True if user.key == game.player_x else False
+            if not user.has_key(game.nextMove):
+                raise endpoints.BadRequestException('It\'s not your turn!')
 
 # Make a move
-        move = request.move
-        size = game.boardSize * game.boardSize - 1
-        if move < 0 or move > size:
-            raise endpoints.BadRequestException('Bad Move!')
-        if game.board[move] != '':
-            raise endpoints.BadRequestException('Invalid Move')
-
-# Make a move, and send the move to game history
-        game.board[move] = 'X' if x else 'O'
-        game.game_history.append(('X' if x else 'O', move))
-        game.nextMove = game.player_o if x else game.player_x
-
-# Check if there is a winner in the game and end the game
-        winner = check_winner(game.board, game.boardSize)
-        if winner:
-            game.end_game(user.key)
-        else:
-            # game ends in a draw
-            if check_full(game.board):
-                game.end_game()
-            else:
-                # Send email reminder to player if game still in progress
-                taskqueue.add(url='/tasks/send_move_email',
-                              params={'user_key': game.nextMove.urlsafe(),
-                                      'game_key': game.key.urlsafe()})
+            if not game.is_valid_move(move):
+                raise endpoints.BadRequestException('Bad Move!')
+            if not game.is_free(move):
+                raise endpoints.BadRequestException('Invalid Move')
+
+# Make a move, send the move to game history and check the lines through it
+            entities = game.take_turn(move)
 
-        game.put()
+# The computer answers straight away in games against it
+            if not game.game_over and game.nextMove == User.computer_key():
+                if not replies:
+                    raise _RepliesNeeded(*start)
+                entities = game.take_turn(replies.pop(0))
+        yield ndb.put_multi_async(entities)
+        raise ndb.Return(game)
+
+    @staticmethod
+    @ndb.tasklet
+    def _publish_move(game):
+        """Does the work that follows a committed move, with the RPCs in
+        parallel. Returns a Future for the game's GameForm"""
+        futures = []
+# Send email reminder to player if game still in progress
+        if not (game.game_over or game.vs_computer):
+            futures.append(queue_turn_emails_async([game.nextMove]))
 
 # Update the Memcache if the game is over
         if game.game_over:
-            taskqueue.add(url='/task/cache_games_finished')
-        return game.to_form()
+            futures.append(ndb.get_context().memcache_delete(MEMCACHE_RANKINGS))
+            futures.append(GameCounter.cache_game_async(game.draw))
 
-    @endpoints.method(response_message=ScoreForms,
+# Write the new state through, so get_game serves it without a datastore read
+        form = yield game.to_form_async()
+        yield [game.cache_form_async(form)] + futures
+        raise ndb.Return(form)
+
+    @endpoints.method(request_message=IMPORT_GAMES_REQUEST,
+                      response_message=StringMessage,
+                      path='games/import',
+                      name='import_games',
+                      http_method='POST')
+    @instrumented
+    def import_games(self, request):
+        """Imports finished games, with their Scores, and adds them to the
+        players' stats and the finished game counters. The Games and Scores
+        are keyed by the import id and each step is logged, so a retry of an
+        import that failed partway finishes it without doubling anything"""
+        if not 0 < len(request.games) <= MAX_IMPORT_GAMES:
+            raise endpoints.BadRequestException(
+                'Send between 1 and %d games' % MAX_IMPORT_GAMES)
+        import_id = request.import_id
+        if not IMPORT_ID.match(import_id):
+            raise endpoints.BadRequestException(
+                'import_id must be 1 to 100 letters, digits, - or _')
+        done, started = ndb.get_multi([ImportLog.key_for(import_id),
+                                       ImportLog.key_for(import_id,
+                                                         'started')])
+        if done:
+            return StringMessage(message='Imported {} games'.format(
+                len(request.games)))
+        names = set(name for imported in request.games
+                    for name in (imported.player_x, imported.player_o))
+        users = dict((name, User.get_current_user_async(name))
+                     for name in names)
+        users = dict((name, user.get_result())
+                     for name, user in users.iteritems())
+        for name in sorted(names):
+            if not users[name]:
+                raise endpoints.NotFoundException(
+                    'User %s does not exists!' % name)
+
+# Replay every game in memory before anything is written
+        entities = []
+        results = collections.defaultdict(lambda: [0, 0, 0])
+        wins = draws = 0
+        for i, imported in enumerate(request.games):
+            boardSize, win_length = self._board_settings(imported.boardSize,
+                                                         imported.win_length)
+            player_x = users[imported.player_x].key
+            player_o = users[imported.player_o].key
+            try:
+                game, score = Game.from_moves(player_x, player_o, boardSize,
+                                              win_length, imported.moves)
+            except ValueError, e:
+                raise endpoints.BadRequestException('Game %d: %s' % (i, e))
+            if not score:
+                raise endpoints.BadRequestException(
+                    'Game %d: the game is not finished' % i)
+            game.key = ndb.Key(Game, '%s:%d' % (import_id, i))
+            score.key = ndb.Key(Score, '%s:%d' % (import_id, i))
+            entities += [game, score]
+            for key in (player_x, player_o):
+                results[key][2] += 1
+            if game.draw:
+                draws += 1
+                results[player_x][1] += 1
+                results[player_o][1] += 1
+            else:
+                wins += 1
+                results[game.winner][0] += 1
+
+        if started:
+            # A retry keeps what the failed attempt wrote, so Scores keep
+            # the created time the analytics job may have read
+            written = ndb.get_multi([entity.key for entity in entities])
+            entities = [entity for entity, stored in zip(entities, written)
+                        if stored is None]
+        else:
+            ImportLog(key=ImportLog.key_for(import_id, 'started')).put()
+        for i in range(0, len(entities), IMPORT_BATCH_SIZE):
+            ndb.put_multi(entities[i:i + IMPORT_BATCH_SIZE])
+        # As in end_game, the computer's stats are not kept
+        results.pop(User.computer_key(), None)
+        User.add_results(results, import_id)
+        if GameCounter.add_games(wins, draws,
+                                 ImportLog.key_for(import_id, 'counters')):
+            GameCounter.cache_games(wins, draws)
+        else:
+            # The failed attempt may not have reached the cached totals
+            GameCounter.cache_totals()
+        ImportLog(key=ImportLog.key_for(import_id)).put()
+        memcache.delete(MEMCACHE_RANKINGS)
+        return StringMessage(message='Imported {} games'.format(
+            len(request.games)))
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @instrumented
+    def get_hint(self, request):
+        """Return the computer's best move for the player whose turn it is"""
+        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        if not game:
+            raise endpoints.NotFoundException('Game not found')
+        if game.game_over:
+            raise endpoints.BadRequestException('Game over!')
+        return HintForm(move=ai.best_move(game.engine, game.next_mark))
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of scores"""
+        scores, cursor = fetch_page(Score.query().order(Score.key),
+                                    request.page_size, request.cursor)
+        forms = Score.to_forms(scores)
+        forms.next_cursor = cursor
+        return forms
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of an individual User's scores"""
+        user = User.get_current_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = Score.query(ndb.OR(Score.player_x == user.key,
-                                    Score.player_o == user.key))
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores = Score.query(Score.players == user.key).order(-Score.created)
+        scores, cursor = fetch_page(scores, request.page_size, request.cursor)
+        forms = Score.to_forms(scores)
+        forms.next_cursor = cursor
+        return forms
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='usergames',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Return active games for Users"""
+        """Return a page of active games for Users"""
         user = User.get_current_user(request.user_name)
         if not user:
             raise endpoints.BadRequestException('User not found!')
-        games = Game.query(ndb.OR(Game.player_x == user.key,
-                                  Game.player_o == user.key)).filter(Game.game_over == False)
-        return GameForms(items=[game.to_form() for game in games])
+        games = Game.query(Game.players == user.key,
+                           Game.game_over == False).order(-Game.created)
+        games, cursor = fetch_page(games, request.page_size, request.cursor)
+        forms = Game.to_forms(games)
+        forms.next_cursor = cursor
+        return forms
 
     @endpoints.method(response_message=StringMessage,
                       path='games/finished_games',
                       name='get_finished_games',
                       http_method='GET')
+    @instrumented
     def get_finished_games(self, request):
         """Get the cached number of games finished"""
-        return StringMessage(message=memcache.get(MEMCACHE_GAMES_PLAYED) or '')
+        return StringMessage(message='The games finished number is %s' %
+                             GameCounter.totals()['games_finished'])
 
-    @staticmethod
-    def _update_finished_games():
-        """Populates memcache with the number of games finished"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            cont = len(games)
-            memcache.set(MEMCACHE_GAMES_PLAYED, 'The games finished number is %s' % cont),
+    @endpoints.method(response_message=GameStatsForm,
+                      path='games/stats',
+                      name='get_game_stats',
+                      http_method='GET')
+    @instrumented
+    def get_game_stats(self, request):
+        """Get the number of games finished, won and drawn"""
+        return GameCounter.to_form()
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
         """Return history of User's play"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = Game.get_game(request.urlsafe_game_key)
         if not game:
             raise endpoints.NotFoundException('Game not found')
         return StringMessage(message=str(game.game_history))
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='user/ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
-        """Ranking base on win/draw percentage"""
-        users = User.query(User.totalGamePlayed > 0).fetch()
-        users = sorted(users, key=lambda x: x.points, reverse=True)
-        return UserForms(items=[user.to_form()for user in users])
+        """Ranking base on win/draw percentage. First pages are served from
+        memcache until the next game ends"""
+        return self._rankings_page(request.page_size or DEFAULT_PAGE_SIZE,
+                                   request.cursor)
+
+    @staticmethod
+    def _rankings_page(page_size, cursor=None):
+        """Returns a page of the rankings as UserForms. First pages are read
+        from, or added to, memcache"""
+        cached = {}
+        if not cursor:
+            cached = memcache.get(MEMCACHE_RANKINGS) or {}
+            if page_size in cached:
+                return protojson.decode_message(UserForms, cached[page_size])
+        users, next_cursor = fetch_page(User.rankings(), page_size, cursor)
+        forms = UserForms(items=[user.to_form() for user in users],
+                          next_cursor=next_cursor)
+        if not cursor:
+            cached[page_size] = protojson.encode_message(forms)
+            memcache.set(MEMCACHE_RANKINGS, cached, time=RANKINGS_CACHE_TIME)
+        return forms
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserForm,
+                      path='user/{user_name}/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Return a User's stats and position in the rankings"""
+        user = User.get_current_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException('User not found!')
+        form = user.to_form()
+        cache_key = MEMCACHE_USER_RANK % user.key.id()
+        form.rank = memcache.get(cache_key)
+        if form.rank is None:
+            form.rank = user.get_rank()
+            memcache.set(cache_key, form.rank, time=RANKINGS_CACHE_TIME)
+        return form
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=RatingForm,
+                      path='user/{user_name}/rating',
+                      name='get_user_rating',
+                      http_method='GET')
+    @instrumented
+    def get_user_rating(self, request):
+        """Return a User's Elo rating and record, as of the last analytics
+        run. Users with no rated games have the initial rating"""
+        user = User.get_current_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException('User not found!')
+        rating = PlayerRating.key_for(user.key).get() or PlayerRating()
+        return rating.to_form(user.name)
+
+    @endpoints.method(request_message=HEAD_TO_HEAD_REQUEST,
+                      response_message=HeadToHeadForm,
+                      path='user/{user_name}/versus/{opponent_name}',
+                      name='get_head_to_head',
+                      http_method='GET')
+    @instrumented
+    def get_head_to_head(self, request):
+        """Return the record of a User's games against another, as of the
+        last analytics run"""
+        user = User.get_current_user_async(request.user_name)
+        opponent = User.get_current_user_async(request.opponent_name)
+        user, opponent = user.get_result(), opponent.get_result()
+        if not (user and opponent):
+            raise endpoints.NotFoundException('User not found!')
+        record = HeadToHead.key_for(user.key, opponent.key).get()
+        if not record:
+            first, second = HeadToHead.ordered(user.key, opponent.key)
+            record = HeadToHead(first=first, second=second)
+        return record.to_form(user.key, {user.key: user.name,
+                                         opponent.key: opponent.name})
 
 
 api = endpoints.api_server([TicTacToeApi])
@@ -0,0 +1,293 @@
+"""ai.py - Computer opponent and move hints, built on the bitboard engine in
+board.py.
+
+The classic 3x3 game is solved once per instance: every reachable position
+is reduced to its canonical form under the 8 symmetries of the square and
+the best move for each is kept in a compact dict, so choosing a move is a
+lookup. Larger boards are searched with iterative deepening alpha-beta and
+a Zobrist hashed transposition table, within a per request time budget."""
+
+import random
+import time
+
+from board import Board, X, O, line_masks
+
+# Seconds a search on a large board may take before returning its best move
+DEFAULT_TIME_BUDGET = 0.5
+# Only cells this close to a played cell are searched on large boards
+SEARCH_RADIUS = 1
+WIN_SCORE = 1000000
+
+
+def best_move(board, mark, time_budget=DEFAULT_TIME_BUDGET):
+    """Returns the best cell for mark to play on the board, or None if the
+    board is full"""
+    if board.is_full():
+        return None
+    if board.size == 3 and board.win_length == 3:
+        return _solved_move(board)
+    return _Search(board, mark, time_budget).run()
+
+
+def _other(mark):
+    return O if mark == X else X
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+# - - - - Solved 3x3 table - - - -
+
+def _symmetries():
+    """Returns the 8 symmetries of the 3x3 board as cell permutations"""
+    def rotate(cell):
+        row, col = divmod(cell, 3)
+        return col * 3 + 2 - row
+
+    def mirror(cell):
+        row, col = divmod(cell, 3)
+        return row * 3 + 2 - col
+
+    perms = []
+    perm = range(9)
+    for _ in range(4):
+        perms.append(perm)
+        perms.append([mirror(cell) for cell in perm])
+        perm = [rotate(cell) for cell in perm]
+    return perms
+
+
+_PERMS = _symmetries()
+# _PERM_MASKS[s][mask] is mask with its cells moved by symmetry s
+_PERM_MASKS = [[sum(1 << perm[cell] for cell in range(9) if mask >> cell & 1)
+                for mask in range(512)] for perm in _PERMS]
+_LINES = sorted(set(mask for masks in line_masks(3, 3) for mask in masks))
+_FULL = (1 << 9) - 1
+
+# Canonical position (x << 9 | o) -> best move in canonical cells. Built the
+# first time a 3x3 move is asked for, or by solve() at warmup.
+_solved = {}
+
+
+def _canonical(x, o):
+    """Returns (key, symmetry) for the smallest symmetric image of x, o"""
+    return min((_PERM_MASKS[s][x] << 9 | _PERM_MASKS[s][o], s)
+               for s in range(8))
+
+
+def _has_line(bits):
+    for line in _LINES:
+        if bits & line == line:
+            return True
+    return False
+
+
+def solve():
+    """Solves every reachable 3x3 position. Returns the number of canonical
+    positions that have a move to make"""
+    if not _solved:
+        values = {}
+        _negamax(0, 0, values)
+    return len(_solved)
+
+
+def _negamax(own, other, values):
+    """Returns the value of the position for the side to move, own: more
+    than 0 wins, 0 draws, less than 0 loses. Quicker wins score higher"""
+    x, o = (own, other) if _popcount(own) == _popcount(other) else (other, own)
+    key, s = _canonical(x, o)
+    if key in values:
+        return values[key]
+    best_value, best_cell = None, None
+    empty = ~(own | other) & _FULL
+    for cell in range(9):
+        bit = 1 << cell
+        if not empty & bit:
+            continue
+        if _has_line(own | bit):
+            value = 10 - _popcount(own | other)
+        elif (own | other | bit) == _FULL:
+            value = 0
+        else:
+            value = -_negamax(other, own | bit, values)
+        if best_value is None or value > best_value:
+            best_value, best_cell = value, cell
+    values[key] = best_value
+    # Store the move in canonical cells so every symmetric image shares it
+    _solved[key] = _PERMS[s][best_cell]
+    return best_value
+
+
+def _solved_move(board):
+    """Looks the best move up in the solved 3x3 table"""
+    solve()
+    key, s = _canonical(board.x, board.o)
+    return _PERMS[s].index(_solved[key])
+
+
+# - - - - Search for larger boards - - - -
+
+_ZOBRIST = {}
+
+
+def _zobrist(size):
+    """Returns per cell random 64 bit keys for X and O on a board size"""
+    keys = _ZOBRIST.get(size)
+    if keys is None:
+        rand = random.Random(size)
+        keys = dict((mark, [rand.getrandbits(64) for _ in range(size * size)])
+                    for mark in (X, O))
+        _ZOBRIST[size] = keys
+    return keys
+
+
+class _Timeout(Exception):
+    pass
+
+
+class _Search(object):
+    """Iterative deepening alpha-beta search for one move"""
+    EXACT, LOWER, UPPER = range(3)
+
+    def __init__(self, board, mark, time_budget):
+        self.board = Board(board.size, board.win_length, board.x, board.o)
+        self.mark = mark
+        self.deadline = time.time() + time_budget
+        self.zobrist = _zobrist(board.size)
+        self.windows = sorted(set(mask for masks in
+                                  line_masks(board.size, board.win_length)
+                                  for mask in masks))
+        self.table = {}
+        self.nodes = 0
+        self.hash = 0
+        for cell, cell_mark in board.occupied().iteritems():
+            self.hash ^= self.zobrist[cell_mark][cell]
+
+    def run(self):
+        moves = self.candidates()
+        # Win now, or block the opponent's win, before searching
+        for mark in (self.mark, _other(self.mark)):
+            for cell in moves:
+                if self._wins(cell, mark):
+                    return cell
+        best = moves[0]
+        depth = 1
+        # Without time left, play the first candidate rather than search
+        while depth <= len(moves) and time.time() < self.deadline:
+            try:
+                _, move = self.negamax(depth, -WIN_SCORE - 1, WIN_SCORE + 1,
+                                       self.mark)
+            except _Timeout:
+                break
+            if move is not None:
+                best = move
+            depth += 1
+        return best
+
+    def _wins(self, cell, mark):
+        """Returns True if mark playing cell would win"""
+        self.board.place(cell, mark)
+        won = self.board.is_winning_move(cell, mark)
+        self._unplace(cell, mark)
+        return won
+
+    def _unplace(self, cell, mark):
+        if mark == X:
+            self.board.x &= ~(1 << cell)
+        else:
+            self.board.o &= ~(1 << cell)
+
+    def candidates(self):
+        """Returns the empty cells next to played ones, or the centre of an
+        empty board"""
+        board = self.board
+        size = board.size
+        occupied = board.x | board.o
+        if not occupied:
+            return [(size // 2) * size + size // 2]
+        moves = []
+        for cell in range(size * size):
+            if occupied >> cell & 1:
+                continue
+            row, col = divmod(cell, size)
+            for r in range(max(row - SEARCH_RADIUS, 0),
+                           min(row + SEARCH_RADIUS + 1, size)):
+                for c in range(max(col - SEARCH_RADIUS, 0),
+                               min(col + SEARCH_RADIUS + 1, size)):
+                    if occupied >> (r * size + c) & 1:
+                        moves.append(cell)
+                        break
+                else:
+                    continue
+                break
+        return moves
+
+    def evaluate(self, mark):
+        """Scores the position for mark from the lines each side can still
+        complete, weighting lines by how many marks they already hold"""
+        own = self.board.x if mark == X else self.board.o
+        other = self.board.o if mark == X else self.board.x
+        score = 0
+        for window in self.windows:
+            mine = own & window
+            theirs = other & window
+            if mine and not theirs:
+                score += 10 ** _popcount(mine)
+            elif theirs and not mine:
+                score -= 10 ** _popcount(theirs)
+        return score
+
+    def negamax(self, depth, alpha, beta, mark):
+        """Returns (score, move) for mark to play, searching depth plies"""
+        self.nodes += 1
+        if self.nodes % 256 == 0 and time.time() > self.deadline:
+            raise _Timeout()
+        alpha_start = alpha
+        entry = self.table.get(self.hash)
+        hint = None
+        if entry is not None:
+            entry_depth, value, flag, hint = entry
+            if entry_depth >= depth:
+                if flag == self.EXACT:
+                    return value, hint
+                if flag == self.LOWER:
+                    alpha = max(alpha, value)
+                elif flag == self.UPPER:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value, hint
+        if depth == 0 or self.board.is_full():
+            return self.evaluate(mark), None
+
+        moves = self.candidates()
+        if hint in moves:
+            moves.remove(hint)
+            moves.insert(0, hint)
+        best_value, best_move = -WIN_SCORE - 1, None
+        for cell in moves:
+            self.board.place(cell, mark)
+            self.hash ^= self.zobrist[mark][cell]
+            try:
+                if self.board.is_winning_move(cell, mark):
+                    value = WIN_SCORE + depth
+                else:
+                    value = -self.negamax(depth - 1, -beta, -alpha,
+                                          _other(mark))[0]
+            finally:
+                self.hash ^= self.zobrist[mark][cell]
+                self._unplace(cell, mark)
+            if value > best_value:
+                best_value, best_move = value, cell
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best_value <= alpha_start:
+            flag = self.UPPER
+        elif best_value >= beta:
+            flag = self.LOWER
+        else:
+            flag = self.EXACT
+        self.table[self.hash] = (depth, best_value, flag, best_move)
+        return best_value, best_move
@@ -0,0 +1,278 @@
+"""analytics.py - Offline Elo ratings and head-to-head records, built from
+the Score history.
+
+run() streams Scores in the order they were created, one page per query
+cursor, into an _Accumulator that keeps every User's rating and record and
+every pair's record in flat arrays indexed by dense ids. Once it has a page
+of Scores, it fetches the stored PlayerRating and HeadToHead entities of the
+Users and pairs it has not seen yet in one get_multi, and it fetches the
+next page at the same time. PlayerRating is keyed by User and HeadToHead by
+pair, so the endpoints read either with a single get.
+
+A Score's created time is set when it is put, before the transaction that
+ends its game commits, and the query by created is eventually consistent.
+Runs therefore only read Scores created SAFETY_LAG ago or earlier, and they
+always stop after every Score at a created time has been rated. The
+checkpoint is the created time of the last Score rated, and the next run
+reads the Scores created after it. Each PlayerRating and HeadToHead stores
+the checkpoint it was written at and skips Scores created at or before it.
+If a run writes its results but fails to write the checkpoint, the next run
+rates those Scores again without counting them twice."""
+
+from array import array
+from datetime import datetime, timedelta
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from forms import HeadToHeadForm, RatingForm
+from models import Score
+
+INITIAL_RATING = 1500.0
+K_FACTOR = 32
+PAGE_SIZE = 500
+# Pages one run reads before writing its results
+MAX_PAGES = 40
+# Only one run may stream Scores at a time
+MEMCACHE_LOCK = 'ANALYTICS_LOCK'
+LOCK_TIME = 600
+# Scores younger than this may not have committed or be indexed yet
+SAFETY_LAG = timedelta(minutes=10)
+
+
+class PlayerRating(ndb.Model):
+    """A User's Elo rating and record over the Scores analysed so far"""
+    rating = ndb.FloatProperty(default=INITIAL_RATING, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    draws = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+    # Created time of the last Score counted
+    applied = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key):
+        """Returns the key a User's rating is stored under"""
+        return ndb.Key(cls, user_key.id())
+
+    def to_form(self, name):
+        return RatingForm(name=name,
+                          rating=self.rating,
+                          wins=self.wins,
+                          draws=self.draws,
+                          losses=self.losses)
+
+
+class HeadToHead(ndb.Model):
+    """Record of the games between two Users. first is the User whose
+    urlsafe key sorts first; wins and losses are from first's side"""
+    first = ndb.KeyProperty(kind='User', indexed=False)
+    second = ndb.KeyProperty(kind='User', indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    draws = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+    # Created time of the last Score counted
+    applied = ndb.DateTimeProperty(indexed=False)
+
+    @staticmethod
+    def ordered(user_key, opponent_key):
+        """Returns the pair as (first, second)"""
+        if user_key.urlsafe() <= opponent_key.urlsafe():
+            return user_key, opponent_key
+        return opponent_key, user_key
+
+    @classmethod
+    def key_for(cls, user_key, opponent_key):
+        """Returns the key the record between two Users is stored under"""
+        first, second = cls.ordered(user_key, opponent_key)
+        return ndb.Key(cls, '%s %s' % (first.urlsafe(), second.urlsafe()))
+
+    def to_form(self, user_key, names):
+        """Returns a HeadToHeadForm from user_key's side. names maps both
+        Users' keys to their names"""
+        wins, losses = self.wins, self.losses
+        opponent_key = self.second
+        if user_key != self.first:
+            wins, losses = losses, wins
+            opponent_key = self.first
+        return HeadToHeadForm(player=names.get(user_key),
+                              opponent=names.get(opponent_key),
+                              wins=wins,
+                              draws=self.draws,
+                              losses=losses)
+
+
+class AnalyticsCheckpoint(ndb.Model):
+    """Created time of the last Score rated"""
+    created = ndb.DateTimeProperty(indexed=False)
+    scores = ndb.IntegerProperty(default=0, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    def get(cls):
+        return cls.get_or_insert('scores')
+
+
+class _Accumulator(object):
+    """Ratings and records for one run. Users and pairs get dense ids the
+    first time they are seen, starting from their stored entity if any"""
+
+    def __init__(self):
+        self.users = {}
+        self.user_keys = []
+        self.ratings = array('d')
+        # wins, draws, losses for each User, then for each pair
+        self.records = array('l')
+        # Created time of the last Score already counted by each entity
+        self.user_applied = []
+        self.pairs = {}
+        self.pair_keys = []
+        self.pair_records = array('l')
+        self.pair_applied = []
+
+    def load(self, scores):
+        """Fetches the stored entities of the Users and pairs in scores that
+        have not been seen yet, with one get_multi"""
+        new_users = set()
+        new_pairs = set()
+        for score in scores:
+            for key in (score.player_x, score.player_o):
+                if key not in self.users:
+                    new_users.add(key)
+            pair = HeadToHead.ordered(score.player_x, score.player_o)
+            if pair not in self.pairs:
+                new_pairs.add(pair)
+        new_users, new_pairs = list(new_users), list(new_pairs)
+        entities = ndb.get_multi(
+            [PlayerRating.key_for(key) for key in new_users] +
+            [HeadToHead.key_for(*pair) for pair in new_pairs])
+        for key, rating in zip(new_users, entities):
+            rating = rating or PlayerRating()
+            self.users[key] = len(self.user_keys)
+            self.user_keys.append(key)
+            self.ratings.append(rating.rating)
+            self.records.extend((rating.wins, rating.draws, rating.losses))
+            self.user_applied.append(rating.applied or datetime.min)
+        for pair, record in zip(new_pairs, entities[len(new_users):]):
+            record = record or HeadToHead()
+            self.pairs[pair] = len(self.pair_keys)
+            self.pair_keys.append(pair)
+            self.pair_records.extend((record.wins, record.draws,
+                                      record.losses))
+            self.pair_applied.append(record.applied or datetime.min)
+
+    def add(self, score):
+        """Rates one game. Its Users and pair must have been loaded. Entities
+        that already counted the Score are left alone"""
+        if score.player_x == score.player_o:
+            return
+        x = self.users[score.player_x]
+        o = self.users[score.player_o]
+        ordered = HeadToHead.ordered(score.player_x, score.player_o)
+        pair = self.pairs[ordered]
+        apply_x = score.created > self.user_applied[x]
+        apply_o = score.created > self.user_applied[o]
+        apply_pair = score.created > self.pair_applied[pair]
+
+        if score.result == 'player_x':
+            result_x = 1.0
+        elif score.result == 'player_o':
+            result_x = 0.0
+        else:
+            result_x = 0.5
+        expected_x = 1 / (1 + 10 ** ((self.ratings[o] - self.ratings[x]) /
+                                     400))
+        change = K_FACTOR * (result_x - expected_x)
+
+        # Record offsets of a win, a draw and a loss for x
+        offset_x = {1.0: 0, 0.5: 1, 0.0: 2}[result_x]
+        if apply_x:
+            self.ratings[x] += change
+            self.records[3 * x + offset_x] += 1
+        if apply_o:
+            self.ratings[o] -= change
+            self.records[3 * o + 2 - offset_x] += 1
+        if apply_pair:
+            offset = offset_x if ordered[0] == score.player_x else 2 - offset_x
+            self.pair_records[3 * pair + offset] += 1
+
+    def entities(self, applied):
+        """Returns a PlayerRating for every User and a HeadToHead for every
+        pair seen, marked as having counted the Scores up to applied"""
+        entities = []
+        for i, key in enumerate(self.user_keys):
+            wins, draws, losses = self.records[3 * i:3 * i + 3]
+            entities.append(PlayerRating(key=PlayerRating.key_for(key),
+                                         rating=self.ratings[i],
+                                         wins=wins,
+                                         draws=draws,
+                                         losses=losses,
+                                         applied=applied))
+        for i, (first, second) in enumerate(self.pair_keys):
+            wins, draws, losses = self.pair_records[3 * i:3 * i + 3]
+            entities.append(HeadToHead(key=HeadToHead.key_for(first, second),
+                                       first=first,
+                                       second=second,
+                                       wins=wins,
+                                       draws=draws,
+                                       losses=losses,
+                                       applied=applied))
+        return entities
+
+
+def run(page_size=PAGE_SIZE, max_pages=MAX_PAGES):
+    """Rates the Scores created since the last checkpoint, about max_pages
+    pages of them, and writes the results and a new checkpoint. Returns
+    (Scores rated, whether more remain), or (0, False) if another run holds
+    the lock"""
+    if not memcache.add(MEMCACHE_LOCK, 1, time=LOCK_TIME):
+        return 0, False
+    try:
+        return _run(page_size, max_pages)
+    finally:
+        memcache.delete(MEMCACHE_LOCK)
+
+
+def _run(page_size, max_pages):
+    checkpoint = AnalyticsCheckpoint.get()
+    query = Score.query(Score.created <= datetime.utcnow() - SAFETY_LAG)
+    if checkpoint.created:
+        query = query.filter(Score.created > checkpoint.created)
+    query = query.order(Score.created)
+    accumulator = _Accumulator()
+    rated = 0
+    last_created = None
+    more = True
+    page = query.fetch_page_async(page_size)
+    pages = 0
+    while more:
+        scores, cursor, more = page.get_result()
+        pages += 1
+        stop = False
+        if pages > max_pages:
+            # Past the page limit, only finish the Scores created at the
+            # same time as the last one rated, so the checkpoint splits none
+            tied = [score for score in scores
+                    if score.created == last_created]
+            if len(tied) < len(scores):
+                scores, stop = tied, True
+        # Read the next page while this one is rated
+        if more and not stop:
+            page = query.fetch_page_async(page_size, start_cursor=cursor)
+        if scores:
+            accumulator.load(scores)
+        for score in scores:
+            accumulator.add(score)
+            last_created = score.created
+            rated += 1
+        if stop:
+            more = True
+            break
+
+    if rated:
+        # Results first: if the checkpoint is not written, the entities
+        # already record which Scores they counted
+        ndb.put_multi(accumulator.entities(last_created))
+        checkpoint.created = last_created
+        checkpoint.scores += rated
+        checkpoint.put()
+    return rated, more
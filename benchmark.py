@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Simulates many concurrent games against the endpoint
+methods in process (see localdev.py) and reports latency percentiles and
+RPCs per endpoint, so regressions show up before deploy. Needs the App Engine
+SDK on the path, e.g.
+
+    python benchmark.py --users 200 --games 2000 --board-size 3
+"""
+
+import argparse
+import collections
+import random
+
+from localdev import LocalApi
+
+
+def percentile(values, fraction):
+    """Returns the value below which fraction of the sorted values fall"""
+    if not values:
+        return 0
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class Report(object):
+    """Collects every Call by endpoint"""
+
+    def __init__(self):
+        self.calls = collections.defaultdict(list)
+
+    def add(self, call):
+        self.calls[call.method].append(call)
+
+    def rows(self):
+        for method in sorted(self.calls):
+            calls = self.calls[method]
+            seconds = sorted(call.seconds for call in calls)
+            n = float(len(calls))
+            yield (method, len(calls),
+                   sum(1 for call in calls if call.error),
+                   percentile(seconds, 0.5) * 1000,
+                   percentile(seconds, 0.99) * 1000,
+                   sum(call.stats.datastore_gets for call in calls) / n,
+                   sum(call.stats.datastore_puts for call in calls) / n,
+                   sum(call.stats.datastore_queries for call in calls) / n,
+                   sum(call.stats.datastore_rpcs for call in calls) / n,
+                   sum(call.stats.memcache_rpcs for call in calls) / n,
+                   sum(call.stats.taskqueue_adds for call in calls) / n)
+
+    def show(self):
+        header = ('endpoint', 'calls', 'errors', 'p50 ms', 'p99 ms',
+                  'ds get', 'ds put', 'ds query', 'ds rpc', 'mc rpc', 'tq add')
+        print ('%-20s' + '%9s' * (len(header) - 1)) % header
+        for row in self.rows():
+            print ('%-20s%9d%9d' + '%9.2f' * (len(row) - 3)) % row
+
+
+def run(users, games, board_size, reads_every, seed):
+    """Plays games between random pairs of users, interleaving one move per
+    active game per round, with read endpoints called as play goes on"""
+    rand = random.Random(seed)
+    api = LocalApi()
+    report = Report()
+    try:
+        names = ['player%d@example.com' % i for i in range(users)]
+        for name in names:
+            _, call = api.call('create_user', user_name=name, email=name)
+            report.add(call)
+
+        active = []
+        for _ in range(games):
+            player_x, player_o = rand.sample(names, 2)
+            form, call = api.call('new_game', player_x=player_x,
+                                  player_o=player_o, boardSize=board_size)
+            report.add(call)
+            active.append({'key': form.urlsafe_key,
+                           'next': form.nextMove,
+                           'free': range(board_size * board_size)})
+
+        moves = 0
+        while active:
+            rand.shuffle(active)
+            for game in list(active):
+                move = game['free'].pop(rand.randrange(len(game['free'])))
+                form, call = api.call('make_move',
+                                      urlsafe_game_key=game['key'],
+                                      user_name=game['next'], move=move)
+                report.add(call)
+                moves += 1
+                if form is None or form.game_over:
+                    active.remove(game)
+                else:
+                    game['next'] = form.nextMove
+
+                if moves % reads_every == 0:
+                    name = rand.choice(names)
+                    for method, fields in (
+                            ('get_game', {'urlsafe_game_key': game['key']}),
+                            ('get_game_delta',
+                             {'urlsafe_game_key': game['key'],
+                              'since_version': 0}),
+                            ('get_user_games', {'user_name': name}),
+                            ('get_user_scores', {'user_name': name}),
+                            ('get_user_rankings', {}),
+                            ('get_scores', {}),
+                            ('get_game_stats', {})):
+                        _, call = api.call(method, **fields)
+                        report.add(call)
+    finally:
+        api.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--board-size', type=int, default=3)
+    parser.add_argument('--reads-every', type=int, default=10,
+                        help='call the read endpoints every N moves')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    run(args.users, args.games, args.board_size, args.reads_every,
+        args.seed).show()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""board.py - Bitboard engine used to play and score tic tac toe games.
+
+Each player's marks are kept as an integer bitmask where bit n is set when
+the player owns cell n. The winning lines for a (board size, win length) pair
+are precomputed once per instance and indexed by cell, so checking a move only
+looks at the lines that pass through it. Boards too large for a line table
+(gomoku style 15x15 or 19x19) are checked by scanning a window of win length
+cells around the last move instead, so a move never costs more than the board
+area allows."""
+
+X = 'X'
+O = 'O'
+
+MIN_BOARD_SIZE = 3
+MAX_BOARD_SIZE = 19
+DEFAULT_WIN_LENGTH = 5
+
+# Boards with more cells than this are checked with a window scan
+MAX_TABLE_CELLS = 100
+
+# The four directions a line can run in: row, column, diagonal, anti-diagonal
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+_LINE_TABLES = {}
+
+
+def line_masks(size, win_length):
+    """Returns a tuple indexed by cell holding the masks of every winning line
+    that passes through that cell. Tables are built once and cached."""
+    table = _LINE_TABLES.get((size, win_length))
+    if table is None:
+        table = _build_line_masks(size, win_length)
+        _LINE_TABLES[(size, win_length)] = table
+    return table
+
+
+def _build_line_masks(size, win_length):
+    """Builds the per cell winning line masks for a board"""
+    through = [[] for _ in range(size * size)]
+    for row in range(size):
+        for col in range(size):
+            for d_row, d_col in DIRECTIONS:
+                end_row = row + d_row * (win_length - 1)
+                end_col = col + d_col * (win_length - 1)
+                if not (0 <= end_row < size and 0 <= end_col < size):
+                    continue
+                cells = [(row + d_row * i) * size + col + d_col * i
+                         for i in range(win_length)]
+                mask = 0
+                for cell in cells:
+                    mask |= 1 << cell
+                for cell in cells:
+                    through[cell].append(mask)
+    return tuple(tuple(masks) for masks in through)
+
+
+def default_win_length(size):
+    """Returns the number in a row needed to win on a board of that size"""
+    return min(size, DEFAULT_WIN_LENGTH)
+
+
+class Board(object):
+    """Board state for a single game"""
+    __slots__ = ('size', 'win_length', 'x', 'o')
+
+    def __init__(self, size=3, win_length=None, x=0, o=0):
+        self.size = size
+        self.win_length = win_length or size
+        self.x = x
+        self.o = o
+
+    @classmethod
+    def from_cells(cls, cells, size, win_length=None):
+        """Builds a Board from a list of cells holding 'X', 'O' or ''"""
+        board = cls(size, win_length)
+        for cell, mark in enumerate(cells):
+            if mark:
+                board.place(cell, mark)
+        return board
+
+    @classmethod
+    def from_occupied(cls, occupied, size, win_length=None):
+        """Builds a Board from a dict mapping occupied cells to their mark"""
+        board = cls(size, win_length)
+        for cell, mark in occupied.iteritems():
+            board.place(cell, mark)
+        return board
+
+    def __len__(self):
+        return self.size * self.size
+
+    def mark_at(self, cell):
+        """Returns the mark on a cell, or '' if the cell is empty"""
+        bit = 1 << cell
+        if self.x & bit:
+            return X
+        if self.o & bit:
+            return O
+        return ''
+
+    def is_empty(self, cell):
+        """Returns True if nobody has played the cell yet"""
+        return not (self.x | self.o) & (1 << cell)
+
+    def is_full(self):
+        """Returns True if every cell has been played"""
+        return (self.x | self.o) == (1 << len(self)) - 1
+
+    def place(self, cell, mark):
+        """Puts a mark on a cell without checking for a winner"""
+        if mark == X:
+            self.x |= 1 << cell
+        else:
+            self.o |= 1 << cell
+
+    def play(self, cell, mark):
+        """Puts a mark on a cell. Returns True if the move wins the game"""
+        self.place(cell, mark)
+        return self.is_winning_move(cell, mark)
+
+    def is_winning_move(self, cell, mark):
+        """Returns True if a line through the cell is owned by mark"""
+        bits = self.x if mark == X else self.o
+        if len(self) > MAX_TABLE_CELLS:
+            return self._scan_window(bits, cell)
+        for mask in line_masks(self.size, self.win_length)[cell]:
+            if bits & mask == mask:
+                return True
+        return False
+
+    def _scan_window(self, bits, cell):
+        """Counts marks in a row through the cell, looking no further than
+        win length - 1 cells away in each direction"""
+        size = self.size
+        row, col = divmod(cell, size)
+        reach = self.win_length - 1
+        for d_row, d_col in DIRECTIONS:
+            count = 1
+            for sign in (1, -1):
+                r, c = row, col
+                for _ in range(reach):
+                    r += sign * d_row
+                    c += sign * d_col
+                    if not (0 <= r < size and 0 <= c < size):
+                        break
+                    if not bits & (1 << (r * size + c)):
+                        break
+                    count += 1
+            if count >= self.win_length:
+                return True
+        return False
+
+    def occupied(self):
+        """Returns a dict mapping each played cell to its mark"""
+        occupied = {}
+        for mark, bits in ((X, self.x), (O, self.o)):
+            cell = 0
+            while bits:
+                if bits & 1:
+                    occupied[cell] = mark
+                bits >>= 1
+                cell += 1
+        return occupied
+
+    def cells(self):
+        """Returns the board as a list of 'X', 'O' or '' per cell"""
+        return [self.mark_at(cell) for cell in range(len(self))]
+
+
+# - - - - Compact binary encoding - - - -
+
+# Leading byte of every encoded value. Pickled values start with 0x80.
+ENCODING_VERSION = 1
+
+_CELL_CODES = {'': 0, X: 1, O: 2}
+_CODE_MARKS = ('', X, O, '')
+
+
+def is_encoded(data):
+    """Returns True if the data was written by encode_board/encode_moves"""
+    return bool(data) and ord(data[0]) == ENCODING_VERSION
+
+
+def encode_board(board):
+    """Packs a Board as a version byte, the board size and win length
+    followed by 2 bits per cell, four cells to a byte"""
+    out = bytearray([ENCODING_VERSION, board.size, board.win_length])
+    cells = len(board)
+    byte = 0
+    for cell in range(cells):
+        byte |= _CELL_CODES[board.mark_at(cell)] << (2 * (cell % 4))
+        if cell % 4 == 3:
+            out.append(byte)
+            byte = 0
+    if cells % 4:
+        out.append(byte)
+    return str(out)
+
+
+def decode_board(data):
+    """Unpacks a Board written by encode_board"""
+    data = bytearray(data)
+    board = Board(data[1], data[2])
+    for cell in range(len(board)):
+        mark = _CODE_MARKS[(data[3 + cell // 4] >> (2 * (cell % 4))) & 3]
+        if mark:
+            board.place(cell, mark)
+    return board
+
+
+def encode_moves(moves):
+    """Packs a move history of (mark, cell) tuples as a version byte followed
+    by one varint per cell. Marks are not stored since X always moves first
+    and turns alternate"""
+    out = bytearray([ENCODING_VERSION])
+    for _, cell in moves:
+        while cell >= 0x80:
+            out.append((cell & 0x7f) | 0x80)
+            cell >>= 7
+        out.append(cell)
+    return str(out)
+
+
+def decode_moves(data):
+    """Unpacks a move history written by encode_moves"""
+    moves = []
+    cell = shift = 0
+    for byte in bytearray(data)[1:]:
+        cell |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        moves.append((X if len(moves) % 2 == 0 else O, cell))
+        cell = shift = 0
+    return moves
@@ -17,19 +17,42 @@ class GameForm(messages.Message):
     nextMove = messages.StringField     (6, required=True)
     game_over = messages.BooleanField   (7, required=True)
     winner = messages.StringField       (8)
-    draw = messages.StringField         (9)
+    draw = messages.BooleanField        (9)
+    win_length = messages.IntegerField  (10)
+    version = messages.IntegerField     (11)
 
 
 class GameForms(messages.Message):
     """GameForms -- multiple games outbound form message"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class MoveForm(messages.Message):
+    """MoveForm for a single move in a game's history"""
+    mark = messages.StringField         (1, required=True)
+    move = messages.IntegerField        (2, required=True)
+
+
+class GameDeltaForm(messages.Message):
+    """GameDeltaForm -- what changed in a game since a version. Only version
+    and modified are set when nothing changed"""
+    version = messages.IntegerField     (1, required=True)
+    modified = messages.BooleanField    (2, required=True)
+    moves = messages.MessageField(MoveForm, 3, repeated=True)
+    nextMove = messages.StringField     (4)
+    game_over = messages.BooleanField   (5)
+    winner = messages.StringField       (6)
+    draw = messages.BooleanField        (7)
 
 
 class NewGameForm(messages.Message):
     """Used to create a new game"""
     player_x = messages.StringField     (1, required=True)
-    player_o = messages.StringField     (2, required=True)
+    player_o = messages.StringField     (2)
     boardSize = messages.IntegerField   (3)
+    win_length = messages.IntegerField  (4)
+    vs_computer = messages.BooleanField (5)
 
 
 class MakeMoveForm(messages.Message):
@@ -37,6 +60,31 @@ class MakeMoveForm(messages.Message):
     user_name = messages.StringField    (1, required=True)
     move = messages.IntegerField        (2, required=True)
 
+
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in an existing game, in order"""
+    moves = messages.MessageField(MakeMoveForm, 1, repeated=True)
+
+
+class ImportGameForm(messages.Message):
+    """A finished game to import, as its moves in order from 'X'"""
+    player_x = messages.StringField     (1, required=True)
+    player_o = messages.StringField     (2, required=True)
+    boardSize = messages.IntegerField   (3)
+    win_length = messages.IntegerField  (4)
+    moves = messages.IntegerField       (5, repeated=True)
+
+
+class ImportGamesForm(messages.Message):
+    """Used to import many finished games. A retry sends the same import_id
+    and games"""
+    games = messages.MessageField(ImportGameForm, 1, repeated=True)
+    import_id = messages.StringField    (2, required=True)
+
+class HintForm(messages.Message):
+    """HintForm for the suggested next move in a game"""
+    move = messages.IntegerField        (1, required=True)
+
 # Score Forms
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
@@ -49,6 +97,32 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class GameStatsForm(messages.Message):
+    """GameStatsForm for outbound finished game counts"""
+    games_finished = messages.IntegerField  (1, required=True)
+    wins = messages.IntegerField            (2, required=True)
+    draws = messages.IntegerField           (3, required=True)
+
+
+class RatingForm(messages.Message):
+    """RatingForm for a User's Elo rating and record"""
+    name = messages.StringField         (1, required=True)
+    rating = messages.FloatField        (2, required=True)
+    wins = messages.IntegerField        (3, required=True)
+    draws = messages.IntegerField       (4, required=True)
+    losses = messages.IntegerField      (5, required=True)
+
+
+class HeadToHeadForm(messages.Message):
+    """HeadToHeadForm for the record between two Users, from player's side"""
+    player = messages.StringField       (1, required=True)
+    opponent = messages.StringField     (2, required=True)
+    wins = messages.IntegerField        (3, required=True)
+    draws = messages.IntegerField       (4, required=True)
+    losses = messages.IntegerField      (5, required=True)
 
 
 class StringMessage(messages.Message):
@@ -66,8 +140,10 @@ class UserForm(messages.Message):
     totalGamePlayed = messages.IntegerField         (5, required=True)
     cal_win_draw_percentage = messages.FloatField   (6, required=True)
     points = messages.IntegerField                  (7)
+    rank = messages.IntegerField                    (8)
 
 
 class UserForms(messages.Message):
     """UserForms -- multiple users outbound form message"""
-    items = messages.MessageField(UserForm, 1, repeated=True)
\ No newline at end of file
+    items = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
\ No newline at end of file
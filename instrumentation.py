@@ -0,0 +1,173 @@
+"""instrumentation.py - Hot path accounting for the endpoint methods.
+
+Every endpoint method is wrapped with @instrumented, under @endpoints.method.
+Each call records its wall time, datastore gets/puts/queries and memcache
+hits/misses (counted by rpcstats) into per minute counters and a latency
+histogram kept in memcache. Calls add to this instance's pending counts,
+which are written at most every FLUSH_SECONDS, so a call does not wait on
+memcache. A sample of calls also records the serialized response size and
+logs a trace of every RPC the call made. summary() reads the counters back
+for the admin stats page at /admin/stats."""
+
+import bisect
+import functools
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+from protorpc import protojson
+
+import rpcstats
+
+MEMCACHE_STATS = 'ENDPOINT_STATS:'
+WINDOW_SECONDS = 60
+# Counters expire once summary() no longer reads their window
+STATS_CACHE_TIME = 2 * 3600
+# Longest an instance holds counts before writing them
+FLUSH_SECONDS = 5
+# Upper bounds of the latency histogram buckets, in milliseconds. Slower
+# calls fall in a last, unbounded bucket
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Fraction of calls that measure their response size and log a trace
+TRACE_SAMPLE_RATE = 0.01
+COUNTERS = ('calls', 'errors', 'datastore_gets', 'datastore_puts',
+            'datastore_queries', 'memcache_hits', 'memcache_misses',
+            'sampled', 'response_bytes')
+
+# Names of the instrumented endpoint methods
+ENDPOINTS = []
+
+# Counts not yet written, by memcache key, and when they were last written
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = [time.time()]
+
+
+def instrumented(method):
+    """Decorates an endpoint method to record its cost on every call"""
+    name = method.__name__
+    ENDPOINTS.append(name)
+
+    @functools.wraps(method)
+    def wrapper(service, request):
+        sampled = random.random() < TRACE_SAMPLE_RATE
+        stats = rpcstats.start(keep_trace=sampled)
+        start = time.time()
+        response = None
+        try:
+            response = method(service, request)
+            return response
+        finally:
+            seconds = time.time() - start
+            rpcstats.stop()
+            record(name, seconds, stats, response, sampled)
+    return wrapper
+
+
+def _window_prefix(window, name):
+    return '%s%d:%s:' % (MEMCACHE_STATS, window, name)
+
+
+def record(name, seconds, stats, response, sampled):
+    """Adds one call to the current window's pending counts, and writes the
+    counts if they are due. A call without a response raised an error"""
+    bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)
+    offsets = {'calls': 1,
+               'errors': int(response is None),
+               'datastore_gets': stats.datastore_gets,
+               'datastore_puts': stats.datastore_puts,
+               'datastore_queries': stats.datastore_queries,
+               'memcache_hits': stats.memcache_hits,
+               'memcache_misses': stats.memcache_misses,
+               'latency:%d' % bucket: 1}
+    if sampled and response is not None:
+        size = len(protojson.encode_message(response))
+        offsets['sampled'] = 1
+        offsets['response_bytes'] = size
+        logging.info('%s took %.1fms, %d byte response, RPCs: %s', name,
+                     seconds * 1000, size,
+                     ', '.join('%s.%s @%.1fms %.1fms' % (
+                         service, call, start * 1000, duration * 1000)
+                         for service, call, start, duration in stats.trace))
+    now = time.time()
+    prefix = _window_prefix(int(now) // WINDOW_SECONDS, name)
+    with _pending_lock:
+        for key, n in offsets.iteritems():
+            if n:
+                _pending[prefix + key] = _pending.get(prefix + key, 0) + n
+        if now - _last_flush[0] < FLUSH_SECONDS:
+            return
+        counts = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = now
+    flush(counts)
+
+
+def flush(counts):
+    """Adds counts, by memcache key, to the counters. Counters are created
+    with an expiry first, as offset_multi cannot set one"""
+    memcache.add_multi(dict.fromkeys(counts, 0), time=STATS_CACHE_TIME)
+    memcache.offset_multi(counts, initial_value=0)
+
+
+def _histogram_percentile(buckets, fraction):
+    """Returns the upper bound, in ms, of the bucket holding the percentile.
+    None stands for the unbounded bucket"""
+    total = sum(buckets)
+    if not total:
+        return 0
+    seen = 0
+    for index, count in enumerate(buckets):
+        seen += count
+        if seen >= fraction * total:
+            if index < len(LATENCY_BUCKETS_MS):
+                return LATENCY_BUCKETS_MS[index]
+            return None
+    return None
+
+
+def summary(minutes=10):
+    """Returns the last minutes of counters as a dict by endpoint, with the
+    p50/p99 latency bounds and the mean cost per call. Every counter is read
+    with one get_multi"""
+    now = int(time.time()) // WINDOW_SECONDS
+    names = COUNTERS + tuple('latency:%d' % bucket for bucket in
+                             range(len(LATENCY_BUCKETS_MS) + 1))
+    windows = range(now - minutes + 1, now + 1)
+    cached = memcache.get_multi([_window_prefix(window, endpoint) + name
+                                 for endpoint in ENDPOINTS
+                                 for window in windows
+                                 for name in names])
+    result = {}
+    for endpoint in ENDPOINTS:
+        totals = dict((name, 0) for name in names)
+        for window in windows:
+            prefix = _window_prefix(window, endpoint)
+            for name in names:
+                totals[name] += cached.get(prefix + name, 0)
+        calls = totals['calls']
+        if not calls:
+            continue
+        buckets = [totals['latency:%d' % bucket]
+                   for bucket in range(len(LATENCY_BUCKETS_MS) + 1)]
+        lookups = totals['memcache_hits'] + totals['memcache_misses']
+        result[endpoint] = {
+            'calls': calls,
+            'errors': totals['errors'],
+            'p50_ms': _histogram_percentile(buckets, 0.5),
+            'p99_ms': _histogram_percentile(buckets, 0.99),
+            'latency_histogram': dict(zip(
+                [str(bound) for bound in LATENCY_BUCKETS_MS] + ['inf'],
+                buckets)),
+            'datastore_gets': float(totals['datastore_gets']) / calls,
+            'datastore_puts': float(totals['datastore_puts']) / calls,
+            'datastore_queries': float(totals['datastore_queries']) / calls,
+            'memcache_hit_rate': (float(totals['memcache_hits']) / lookups
+                                  if lookups else None),
+            'response_bytes': (float(totals['response_bytes']) /
+                               totals['sampled'] if totals['sampled']
+                               else None),
+        }
+    return result
@@ -0,0 +1,78 @@
+"""localdev.py - Runs the real TicTacToeApi endpoint methods in process.
+
+LocalApi activates the App Engine SDK testbed, which stands in for the
+datastore, memcache, taskqueue and mail with in-memory stubs, and calls
+endpoint methods directly with their request messages. Each call counts its
+RPCs with rpcstats and starts with an empty ndb context cache, like a new
+request would. Needs the App Engine SDK on the path:
+
+    api = LocalApi()
+    api.call('create_user', user_name='a@example.com', email='a@example.com')
+    form, call = api.call('new_game', player_x='a@example.com', ...)
+    call.seconds, call.stats.datastore_rpcs
+    api.close()
+"""
+
+import time
+
+import endpoints
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import rpcstats
+from TTTAPI import TicTacToeApi
+
+
+class Call(object):
+    """Timing, RPC counts and outcome of one endpoint call"""
+
+    def __init__(self, method, seconds, stats, error=None):
+        self.method = method
+        self.seconds = seconds
+        self.stats = stats
+        self.error = error
+
+
+class LocalApi(object):
+    """TicTacToeApi backed by in-memory stubs"""
+
+    def __init__(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # Queries see writes straight away, as ancestor queries would
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_urlfetch_stub()
+        rpcstats.install()
+        self.service = TicTacToeApi()
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def request(self, method, **fields):
+        """Builds the request message an endpoint method takes"""
+        request_type = getattr(TicTacToeApi, method).remote.request_type
+        return request_type(**fields)
+
+    def call(self, method, **fields):
+        """Calls an endpoint method as a fresh request. Returns the response,
+        or None if the method raised an endpoints error, and the Call"""
+        request = self.request(method, **fields)
+        ndb.get_context().clear_cache()
+        stats = rpcstats.start()
+        start = time.time()
+        response = error = None
+        try:
+            response = getattr(self.service, method)(request)
+        except endpoints.ServiceException, e:
+            error = e
+        finally:
+            seconds = time.time() - start
+            rpcstats.stop()
+        return response, Call(method, seconds, stats, error)
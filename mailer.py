@@ -0,0 +1,83 @@
+"""mailer.py - Pluggable sinks for the emails the game sends. Handlers send
+through get_mail_sink(), which is App Engine's mail API unless another sink
+is installed with set_mail_sink(), such as MemoryMailSink when measuring
+email throughput locally.
+
+Turn notifications are coalesced: queue_turn_emails_async names each task
+after the User and the current interval, so however many moves hand a User
+the turn in one interval, the task queue keeps a single task that sends one
+digest."""
+
+import time
+
+from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+# Seconds of moves coalesced into one turn notification per User
+TURN_EMAIL_INTERVAL = 300
+# Most tasks the task queue accepts in one add
+TASK_BATCH_SIZE = 100
+
+
+class AppEngineMailSink(object):
+    """Sends email with the App Engine mail API"""
+
+    def send(self, to, subject, body):
+        app_id = app_identity.get_application_id()
+        # This will send test emails, the arguments to send_mail are:
+        # from, to, subject, body
+        mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                       to,
+                       subject,
+                       body)
+
+
+class MemoryMailSink(object):
+    """Keeps sent email in memory as (to, subject, body) tuples"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, to, subject, body):
+        self.sent.append((to, subject, body))
+
+
+_sink = AppEngineMailSink()
+
+
+def get_mail_sink():
+    """Returns the sink email is currently sent through"""
+    return _sink
+
+
+def set_mail_sink(sink):
+    """Sends all email through sink. Returns the previous sink"""
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+@ndb.tasklet
+def queue_turn_emails_async(user_keys):
+    """Queues a digest email for each User whose turn it now is, sent at the
+    end of the current interval, returning a Future. Users already queued
+    for the interval are skipped by the task queue. The batches are added in
+    parallel"""
+    window = int(time.time()) // TURN_EMAIL_INTERVAL
+    eta = (window + 1) * TURN_EMAIL_INTERVAL
+    tasks = [taskqueue.Task(url='/tasks/send_move_email',
+                            name='move-email-%s-%d' % (key.urlsafe(), window),
+                            params={'user_key': key.urlsafe()},
+                            countdown=max(eta - time.time(), 0))
+             for key in set(user_keys)]
+    queue = taskqueue.Queue()
+    rpcs = [queue.add_async(tasks[i:i + TASK_BATCH_SIZE])
+            for i in range(0, len(tasks), TASK_BATCH_SIZE)]
+    for rpc in rpcs:
+        try:
+            yield rpc
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # The rest of the batch is still added
+            pass
@@ -1,43 +1,364 @@
 #!/usr/bin/env python
 
 """main.py - This file contains handlers that are called by taskqueue and/or
-cronjobs."""
+cronjobs. Modules only some handlers need, such as the endpoint API, are
+imported inside those handlers, so an instance starts serving tasks without
+loading them."""
+import datetime
+import json
 import logging
+import time
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-from TTTAPI import TicTacToeApi
-from utils import get_by_urlsafe
+from mailer import get_mail_sink
 
-from models import User, Game 
+from models import User, Game, Score, ArchivedGame, GameCounter
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+    BATCH_SIZE = 50
+
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+        """Send a reminder email to each User whose turn it is in an active
+        game. Called every hour using a cron job, which sends the first batch"""
+        self.post()
+
+    def post(self):
+        """Sends one batch of reminders and chains a task, with the query
+        cursor, for the next batch"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        # One row per User waiting on a move, however many games they have
+        waiting = Game.query(Game.game_over == False,
+                             projection=[Game.nextMove], distinct=True)
+        games, cursor, more = waiting.fetch_page(self.BATCH_SIZE,
+                                                 start_cursor=cursor)
+        users = ndb.get_multi([game.nextMove for game in games])
+
+        sink = get_mail_sink()
+        start = time.time()
+        sent = 0
         for user in users:
+            if not (user and user.email):
+                continue
             subject = 'This is a reminder!'
-            body = 'Hello {}, try out Tic tac toe game!'.format(user.name)
-            # This will send test emails, the arguments to send_mail are:
-            # from, to, subject, body
-            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                           user.email,
-                           subject,
-                           body)
+            body = 'Hello {}, it is your turn in Tic tac toe!'.format(
+                user.name)
+            sink.send(user.email, subject, body)
+            sent += 1
+        elapsed = time.time() - start
+        logging.info('Sent %d reminders in %.3fs (%.1f emails/sec)', sent,
+                     elapsed, sent / elapsed if elapsed else 0)
+
+        if more and cursor:
+            taskqueue.add(url=self.request.path,
+                          params={'cursor': cursor.urlsafe()})
+
+
+class SendMoveEmail(webapp2.RequestHandler):
+    def post(self):
+        """Send a User one email listing every game waiting on their move.
+        Queued by make_move, at most once per User per interval; games that
+        moved on since are no longer waiting and are left out"""
+        user = ndb.Key(urlsafe=self.request.get('user_key')).get()
+        if not (user and user.email):
+            return
+        waiting = Game.query(Game.game_over == False,
+                             Game.nextMove == user.key).fetch(keys_only=True)
+        if not waiting:
+            logging.info('No games waiting on %s', user.name)
+            return
+        subject = 'It is your turn!'
+        body = 'Hello {}, it is your turn in {} game(s):\n{}'.format(
+            user.name, len(waiting),
+            '\n'.join(key.urlsafe() for key in waiting))
+        get_mail_sink().send(user.email, subject, body)
 
 
 class UpdateGamesFinished(webapp2.RequestHandler):
     def post(self):
         """Update game listing announcement in memcache."""
-        TTTAPI._cache_finished_games()
+        GameCounter.cache_totals()
         self.response.set_status(204)
 
 
+class EndpointStats(webapp2.RequestHandler):
+    def get(self):
+        """Return each endpoint's latency and RPC counts over the last
+        minutes (default 10, 1 to 60) as JSON"""
+        import instrumentation
+        # Importing the API registers its endpoints with instrumentation
+        import TTTAPI
+        try:
+            minutes = int(self.request.get('minutes') or 10)
+        except ValueError:
+            self.abort(400, 'minutes must be a number')
+        minutes = max(1, min(minutes, 60))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.summary(minutes),
+                                       indent=2, sort_keys=True))
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the API and prime the instance and memcache caches. Sent by
+        App Engine to each new instance before it serves traffic"""
+        import warmup
+        for step, seconds in warmup.warm():
+            logging.info('Warmup %s took %.3fs', step, seconds)
+
+
+class UpdateAnalytics(webapp2.RequestHandler):
+    def get(self):
+        """Rate the Scores created since the last run. Called every hour
+        using a cron job"""
+        self.post()
+
+    def post(self):
+        """Runs the analytics job and chains a task while Scores remain"""
+        import analytics
+        rated, more = analytics.run()
+        logging.info('Rated %d scores', rated)
+        if more:
+            taskqueue.add(url=self.request.path)
+
+
+def rewrite(keys, update=None, group_size=1):
+    """Re-reads the entities at keys and puts them back in parallel
+    transactions of up to group_size entities, so a write made since they
+    were queried is never undone. update is called on each entity and
+    returns False to leave it alone. Returns the number of entities put"""
+    futures = [_rewrite(keys[i:i + group_size], update)
+               for i in range(0, len(keys), group_size)]
+    return sum(future.get_result() for future in futures)
+
+
+@ndb.transactional_tasklet(xg=True)
+def _rewrite(keys, update):
+    entities = yield ndb.get_multi_async(keys)
+    entities = [entity for entity in entities if entity is not None and
+                (update is None or update(entity))]
+    yield ndb.put_multi_async(entities)
+    raise ndb.Return(len(entities))
+
+
+def repoint(entity, names, old_key, new_key):
+    """Replaces old_key with new_key in the named key properties of entity.
+    Returns True if any of them held it"""
+    changed = False
+    for name in names:
+        if getattr(entity, name) == old_key:
+            setattr(entity, name, new_key)
+            changed = True
+    return changed
+
+
+class BatchMigration(webapp2.RequestHandler):
+    """Walks a query one page per request and chains a task, with the query
+    cursor, to the same URL for the next page. Subclasses define query and
+    migrate. With KEYS_ONLY, migrate is handed the page's keys, for
+    migrations that re-read their entities in a transaction"""
+    BATCH_SIZE = 100
+    KEYS_ONLY = False
+
+    def query(self):
+        raise NotImplementedError
+
+    def migrate(self, entities):
+        """Updates a page of entities, or of their keys. Returns the number
+        changed"""
+        raise NotImplementedError
+
+    def get(self):
+        """Starts the migration from the first page"""
+        self.post()
+
+    def post(self):
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        entities, cursor, more = self.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor, keys_only=self.KEYS_ONLY)
+        changed = self.migrate(entities)
+        logging.info('%s: updated %d of %d entities',
+                     self.__class__.__name__, changed, len(entities))
+        if more and cursor:
+            taskqueue.add(url=self.request.path,
+                          params={'cursor': cursor.urlsafe()})
+
+
+class MigrateGameEncoding(BatchMigration):
+    """Converts Game entities still stored as pickles to the compact format.
+    Legacy games may still be in play, so each is re-read and put in its own
+    transaction"""
+    KEYS_ONLY = True
+
+    def query(self):
+        return Game.query()
+
+    def migrate(self, keys):
+        return rewrite(keys, lambda game: game.is_legacy)
+
+
+class BackfillUserRankings(BatchMigration):
+    """Re-writes Users so their ranking properties are stored and indexed.
+    Each group of Users is re-read in a transaction, so stats written since
+    the query are kept"""
+    KEYS_ONLY = True
+    # Users per cross-group transaction, which may span 25 entity groups
+    GROUP_SIZE = 25
+
+    def query(self):
+        return User.query()
+
+    def migrate(self, keys):
+        return rewrite(keys, group_size=self.GROUP_SIZE)
+
+
+class BackfillGamePlayers(BatchMigration):
+    """Re-writes Games so their players and created properties are indexed.
+    Each Game is re-read and put in its own transaction, so a move made
+    since the query is kept"""
+    KEYS_ONLY = True
+
+    def query(self):
+        return Game.query()
+
+    def migrate(self, keys):
+        return rewrite(keys)
+
+
+class BackfillScorePlayers(BatchMigration):
+    """Re-writes Scores so their players and created properties are indexed.
+    Scores written before created existed take it from their date, which
+    auto_now_add would otherwise set to the time of the backfill"""
+
+    def query(self):
+        return Score.query()
+
+    def migrate(self, scores):
+        for score in scores:
+            if score.created is None:
+                score.created = datetime.datetime.combine(score.date,
+                                                          datetime.time())
+        ndb.put_multi(scores)
+        return len(scores)
+
+
+class ArchiveGames(BatchMigration):
+    """Moves games finished more than ARCHIVE_AFTER_DAYS ago into compact
+    ArchivedGame records and deletes them from the Game kind. Called daily
+    using a cron job"""
+    ARCHIVE_AFTER_DAYS = 30
+
+    def query(self):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            days=self.ARCHIVE_AFTER_DAYS)
+        return Game.query(Game.game_over == True, Game.ended < cutoff)
+
+    def migrate(self, games):
+        # Archive before deleting: if the delete fails the game is still
+        # served from the Game kind and archived again next run
+        ndb.put_multi([ArchivedGame.from_game(game) for game in games])
+        ndb.delete_multi([game.key for game in games])
+        return len(games)
+
+
+class RekeyUsers(BatchMigration):
+    """Creates an empty copy keyed by name of each User with a numeric id,
+    then hands the old key to RekeyUserReferences. Until it is done, the
+    User is looked up at the old key and the copy only collects the stats of
+    games that already point at it"""
+
+    def query(self):
+        return User.query()
+
+    def migrate(self, users):
+        legacy = [user for user in users
+                  if not isinstance(user.key.id(), basestring)]
+        # A copy from an earlier run may hold stats: it is kept, and its
+        # references are handed over again
+        copies = ndb.get_multi([ndb.Key(User, user.name) for user in legacy])
+        ndb.put_multi([User(id=user.name,
+                            name=user.name,
+                            email=user.email,
+                            rekeyed_from=user.key)
+                       for user, copy in zip(legacy, copies) if copy is None])
+        for user in legacy:
+            taskqueue.add(url='/tasks/rekey_user_references',
+                          params={'old_key': user.key.urlsafe(),
+                                  'new_key': ndb.Key(User, user.name).urlsafe()})
+        return len(legacy)
+
+
+class RekeyUserReferences(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+    GAME_REFERENCES = ('player_x', 'player_o', 'nextMove', 'winner')
+    SCORE_REFERENCES = ('player_x', 'player_o')
+    # Seconds between the merge and a last pass over the references, which
+    # catches games created by requests that read the old User before it
+    SWEEP_DELAY = 120
+
+    def post(self):
+        """Points one batch of Games, ArchivedGames and Scores at a re-keyed
+        User and chains itself until nothing references the old key. It then
+        merges the old User into its copy, and a last pass deletes it"""
+        old_key = ndb.Key(urlsafe=self.request.get('old_key'))
+        new_key = ndb.Key(urlsafe=self.request.get('new_key'))
+        final = bool(self.request.get('final'))
+
+        # Games may be in play: each is re-read and put in its own
+        # transaction, so a move committed since the query is kept
+        game_keys = set()
+        for name in self.GAME_REFERENCES:
+            game_keys.update(Game.query(
+                Game._properties[name] == old_key).fetch(self.BATCH_SIZE,
+                                                         keys_only=True))
+        changed = rewrite(list(game_keys), lambda game: repoint(
+            game, self.GAME_REFERENCES, old_key, new_key))
+
+        # Scores and archives are never written again once put
+        updated = {}
+        for name in self.SCORE_REFERENCES:
+            for score in Score.query(Score._properties[name] == old_key).fetch(
+                    self.BATCH_SIZE):
+                score = updated.setdefault(score.key, score)
+                repoint(score, self.SCORE_REFERENCES, old_key, new_key)
+        # Only players is indexed on an ArchivedGame
+        for archive in ArchivedGame.query(
+                ArchivedGame.players == old_key).fetch(self.BATCH_SIZE):
+            repoint(archive, self.GAME_REFERENCES, old_key, new_key)
+            archive.players = [new_key if key == old_key else key
+                               for key in archive.players]
+            updated[archive.key] = archive
+        ndb.put_multi(updated.values())
+
+        params = {'old_key': old_key.urlsafe(), 'new_key': new_key.urlsafe()}
+        if final:
+            params['final'] = 1
+        if changed or updated:
+            taskqueue.add(url=self.request.path, params=params)
+        elif not final:
+            User.merge_rekeyed(old_key, new_key)
+            params['final'] = 1
+            taskqueue.add(url=self.request.path, params=params,
+                          countdown=self.SWEEP_DELAY)
+        else:
+            User.merge_rekeyed(old_key, new_key, delete=True)
+
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_move_email', SendMoveEmail),
+    ('/crons/archive_games', ArchiveGames),
+    ('/crons/update_analytics', UpdateAnalytics),
+    ('/admin/stats', EndpointStats),
     ('/tasks/cache_games_finished', UpdateGamesFinished),
+    ('/tasks/migrate_game_encoding', MigrateGameEncoding),
+    ('/tasks/backfill_user_rankings', BackfillUserRankings),
+    ('/tasks/backfill_game_players', BackfillGamePlayers),
+    ('/tasks/backfill_score_players', BackfillScorePlayers),
+    ('/tasks/rekey_users', RekeyUsers),
+    ('/tasks/rekey_user_references', RekeyUserReferences),
 ], debug=True)
@@ -2,32 +2,200 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
-from datetime import date
-from forms import GameForm, ScoreForm, UserForm
+from datetime import date, datetime
+import pickle
+import random
+
+from board import (
+    Board,
+    X,
+    O,
+    default_win_length,
+    is_encoded,
+    encode_board,
+    decode_board,
+    encode_moves,
+    decode_moves,
+)
+from forms import (
+    GameDeltaForm,
+    GameForm,
+    GameForms,
+    MoveForm,
+    GameStatsForm,
+    ScoreForm,
+    ScoreForms,
+    UserForm
+)
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from protorpc import protojson
+from utils import get_names, get_names_async, get_key_by_urlsafe, LRUCache
+
+# Cached first pages of the rankings, as a dict of page size to UserForms
+MEMCACHE_RANKINGS = 'RANKINGS_TOP'
+# Cached GameCounter totals, one key per counter
+MEMCACHE_GAME_COUNTERS = 'GAME_COUNTER:'
+# Latest version of a game, by urlsafe key
+MEMCACHE_GAME_VERSION = 'GAME_VERSION:%s'
+# Last rendered GameForm of a game as (version, encoded form), by urlsafe key
+MEMCACHE_GAME_FORM = 'GAME_FORM:%s'
+GAME_FORM_CACHE_TIME = 3600
+
+
+# - - - - Compact property types. - - - -
+
+class BoardProperty(ndb.BlobProperty):
+    """Stores a board.Board packed at 2 bits per cell. Values written before
+    the compact format are unpickled as the list or dict they were stored as
+    and converted by Game.engine"""
+
+    def _validate(self, value):
+        if not isinstance(value, (Board, list, dict)):
+            raise TypeError('Expected a Board, got %r' % (value,))
+
+    def _to_base_type(self, value):
+        return encode_board(value)
+
+    def _from_base_type(self, value):
+        if is_encoded(value):
+            return decode_board(value)
+        return pickle.loads(value)
+
+
+class MoveLogProperty(ndb.BlobProperty):
+    """Stores a game history of (mark, cell) tuples as a varint move log"""
+
+    def _validate(self, value):
+        if not isinstance(value, list):
+            raise TypeError('Expected a list, got %r' % (value,))
+
+    def _to_base_type(self, value):
+        return encode_moves(value)
+
+    def _from_base_type(self, value):
+        if is_encoded(value):
+            return decode_moves(value)
+        return pickle.loads(value)
 
 
 # - - - - NDB model definitions for TicTicToe API. - - - -
 
+# Name of the User that plays for the computer
+COMPUTER_NAME = 'computer'
+
+# Keys of recently seen Users by name. Users are keyed by name, but ones
+# created before that still have numeric ids until they are re-keyed.
+_user_keys = LRUCache(1000)
+
+# This instance's copy of MEMCACHE_GAME_FORM entries
+_game_forms = LRUCache(500)
+
+
 # :::::: USER NDB MODEL :::::::::::
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by name"""
     name = ndb.StringProperty(required = True)
     email = ndb.StringProperty(required = True)
     wins = ndb.IntegerProperty(default = 0)
     draws = ndb.IntegerProperty(default = 0)
     totalGamePlayed = ndb.IntegerProperty(default = 0)
+    # Stored on every put so the rankings can be read from an index
+    points = ndb.ComputedProperty(lambda self: self.wins*3+self.draws)
+    win_draw_percentage = ndb.ComputedProperty(
+        lambda self: self.cal_win_draw_percentage or 0.0)
+    # The computer plays but is never ranked
+    ranked = ndb.ComputedProperty(lambda self: self.totalGamePlayed > 0 and
+                                  self.name != COMPUTER_NAME)
+    # Old key of a re-keyed User, which Games may still name
+    rekeyed_from = ndb.KeyProperty(indexed=False)
+    # Set once the old User's stats are merged in. Until then the User is
+    # still looked up at rekeyed_from
+    merged = ndb.BooleanProperty(default=False, indexed=False)
 
 # User Class Methods
     @classmethod
     def get_current_user(cls, username):
-        """Returns a current user. Returns none if no user is found"""
-        return User.query(User.name == username).get()
+        """Returns a current user. Returns none if no user is found. Looks
+        the user up by key, so ndb's caches can answer it, and only falls
+        back to a name query for Users that have not been re-keyed"""
+        return cls.get_current_user_async(username).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_current_user_async(cls, username):
+        """Like get_current_user, returning a Future for the User"""
+        if not username:
+            raise ndb.Return(None)
+        user = yield ndb.Key(cls, username).get_async()
+        if user is None:
+            key = _user_keys.get(username)
+            if key is not None:
+                user = yield key.get_async()
+            if user is None:
+                user = yield cls.query(cls.name == username).get_async()
+        elif user.rekeyed_from and not user.merged:
+            user = (yield user.rekeyed_from.get_async()) or user
+        if user is None:
+            _user_keys.delete(username)
+        else:
+            _user_keys.set(username, user.key)
+        raise ndb.Return(user)
+
+    @classmethod
+    @ndb.transactional
+    def create(cls, name, email):
+        """Creates a User keyed by name. Returns None if the name is taken"""
+        _user_keys.delete(name)
+        if cls.get_by_id(name):
+            return None
+        user = cls(id=name, name=name, email=email)
+        user.put()
+        return user
+
+    @classmethod
+    def computer_key(cls):
+        """Returns the key of the User that plays for the computer"""
+        return ndb.Key(cls, COMPUTER_NAME)
+
+    @classmethod
+    def get_computer_async(cls):
+        """Returns a Future for the User that plays for the computer,
+        creating it the first time. It has no email so it is never sent
+        reminders, and its stats are not kept, so games against it do not all
+        write to it"""
+        return cls.get_or_insert_async(COMPUTER_NAME, name=COMPUTER_NAME,
+                                       email='')
+
+    def has_key(self, key):
+        """Returns True if key is the User's. A User still at a numeric id
+        also owns the name key it is being re-keyed to, and a re-keyed User
+        its old key"""
+        return (key == self.key or key == ndb.Key(User, self.name) or
+                (self.rekeyed_from is not None and key == self.rekeyed_from))
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def merge_rekeyed(old_key, new_key, delete=False):
+        """Moves the stats of the User at old_key to its re-keyed copy and
+        makes the copy the one looked up. The old User is kept, without
+        stats, for the requests that already read it, unless delete is set"""
+        old, new = ndb.get_multi([old_key, new_key])
+        if old:
+            new.wins += old.wins
+            new.draws += old.draws
+            new.totalGamePlayed += old.totalGamePlayed
+            old.wins = old.draws = old.totalGamePlayed = 0
+        new.merged = True
+        if delete:
+            new.put()
+            old_key.delete()
+        else:
+            ndb.put_multi([entity for entity in (new, old) if entity])
 
     def update_user_stats(self):
-        """Adds Game played to the user, and update user status each time a new game starts"""
+        """Adds Game played to the user. The caller puts the User"""
         self.totalGamePlayed +=1
-        self.put()
 
     def user_win(self):
         """Adds a win to user stats each time user wins a game"""
@@ -43,11 +211,64 @@ class User(ndb.Model):
         """Adds a loss when user loses a game"""
         self.update_user_stats()
 
+    # Users updated per transaction, within the 25 entity groups one
+    # cross-group transaction may span
+    RESULTS_BATCH_SIZE = 20
+
+    @classmethod
+    def add_results(cls, results, import_id=None):
+        """Adds many games to Users' stats. results maps User keys to
+        (wins, draws, played) tuples. Batches of Users are updated in
+        parallel transactions. With an import_id, each batch logs that it
+        was applied, so a retried import adds it once"""
+        keys = sorted(results, key=lambda key: key.urlsafe())
+        futures = []
+        for i in range(0, len(keys), cls.RESULTS_BATCH_SIZE):
+            log_key = (ImportLog.key_for(import_id, 'users-%d' % i)
+                       if import_id else None)
+            futures.append(cls._add_results(
+                dict((key, results[key])
+                     for key in keys[i:i + cls.RESULTS_BATCH_SIZE]),
+                log_key))
+        for future in futures:
+            future.get_result()
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _add_results(results, log_key=None):
+        if log_key is not None and (yield log_key.get_async()):
+            return
+        users = yield ndb.get_multi_async(list(results))
+        for user in users:
+            wins, draws, played = results[user.key]
+            user.wins += wins
+            user.draws += draws
+            user.totalGamePlayed += played
+        if log_key is not None:
+            users.append(ImportLog(key=log_key))
+        yield ndb.put_multi_async(users)
+
+    @classmethod
+    def rankings(cls):
+        """Returns a query for the Users who played, best ranked first"""
+        return cls.query(cls.ranked == True).order(-cls.points,
+                                                   -cls.win_draw_percentage)
+
+    def get_rank(self):
+        """Returns the User's position in the rankings, or None if the User
+        has not played. Only counts index entries above the User"""
+        if not self.ranked:
+            return None
+        # Both counts run in parallel
+        above = User.query(User.ranked == True,
+                           User.points > self.points).count_async()
+        tied_above = User.query(User.ranked == True,
+                                User.points == self.points,
+                                User.win_draw_percentage >
+                                self.win_draw_percentage).count_async()
+        return above.get_result() + tied_above.get_result() + 1
+
 # User Class Property
-    @property
-    def points(self):
-        """returns the User win and draw points"""
-        return self.wins*3+self.draws
 
     @property
     def cal_win_percentage(self):
@@ -61,6 +282,8 @@ class User(ndb.Model):
         """Returns calculation User wins plus draws for the amount of game played"""
         if self.totalGamePlayed > 0:
             return (float(self.wins) + float(self.draws)) / float(self.totalGamePlayed)
+        else:
+            return 0.0
 
     def to_form(self):
         return UserForm(name = self.name,
@@ -75,77 +298,378 @@ class User(ndb.Model):
 #::::::: GAME NDB MODEL :::::::
 class Game(ndb.Model):
     """Game object"""
-    board = ndb.PickleProperty          (required=True)
+    board = BoardProperty               (required=True)
     boardSize = ndb.IntegerProperty     (required=True, default=3)
+    win_length = ndb.IntegerProperty    ()
     player_x = ndb.KeyProperty          (required=True, kind='User')
     player_o = ndb.KeyProperty          (required=True, kind='User')
     nextMove = ndb.KeyProperty          (required=True)
     winner = ndb.KeyProperty()
     draw = ndb.BooleanProperty          (default=False)
     game_over = ndb.BooleanProperty     (required=True, default=False)
-    game_history = ndb.PickleProperty   (required=True)
+    game_history = MoveLogProperty      (required=True)
+    # Number of moves played. Computed from the history, so games played
+    # before it was stored get theirs on read
+    version = ndb.ComputedProperty      (lambda self: len(self.game_history),
+                                         indexed=False)
+    # Both players, so a User's games are one index scan
+    players = ndb.KeyProperty           (kind='User', repeated=True)
+    created = ndb.DateTimeProperty      (auto_now_add=True)
+    ended = ndb.DateTimeProperty        ()
 
 # Game Class Methods
     @classmethod
-    def new_game(cls, player_x, player_o, boardSize=3):
+    def new_game(cls, player_x, player_o, boardSize=3, win_length=None):
         """Creates and returns a new game"""
         game = Game(player_x=player_x,
                     player_o=player_o,
                     nextMove=player_x)
-        game.board = ['' for _ in range(boardSize*boardSize)]
-        game.game_history = []
         game.boardSize = boardSize
+        game.win_length = win_length or default_win_length(boardSize)
+        game.board = Board(boardSize, game.win_length)
+        game.game_history = []
         game.put()
         return game
 
-    def to_form(self):
-        """Returns a GameForm representation of the Game"""
+    @classmethod
+    def from_moves(cls, player_x, player_o, boardSize, win_length, moves):
+        """Returns an unsaved Game with the moves played in turn from X, and
+        its Score if the moves end it. Raises ValueError if a move is not a
+        free cell or is played after the game ended"""
+        game = Game(player_x=player_x,
+                    player_o=player_o,
+                    nextMove=player_x,
+                    boardSize=boardSize,
+                    win_length=win_length,
+                    board=Board(boardSize, win_length),
+                    game_history=[])
+        score = None
+        for move in moves:
+            if game.game_over:
+                raise ValueError('Move %d played after the game ended' % move)
+            if not (game.is_valid_move(move) and game.is_free(move)):
+                raise ValueError('Invalid Move %d' % move)
+            mark = game.next_mark
+            if game.play(move, mark):
+                score = game.finish(player_x if mark == X else player_o)
+            elif game.is_full():
+                score = game.finish()
+        return game, score
+
+    @property
+    def engine(self):
+        """Returns the bitboard engine for the board. Boards still pickled in
+        the legacy format are converted the first time they are read"""
+        board = self.board
+        if isinstance(board, Board):
+            return board
+        # Legacy games store a dense list, or a dict of occupied cells, and
+        # win with a full row when win_length is unset
+        if isinstance(board, dict):
+            board = Board.from_occupied(board, self.boardSize, self.win_length)
+        else:
+            board = Board.from_cells(board, self.boardSize, self.win_length)
+        self.board = board
+        return board
+
+    @property
+    def is_legacy(self):
+        """Returns True if the game is still stored in the pickled format"""
+        return not isinstance(self.board, Board)
+
+    def _pre_put_hook(self):
+        """Converts legacy boards so they are written in the compact format
+        and keeps players in step with player_x and player_o"""
+        self.engine
+        self.players = [self.player_x, self.player_o]
+        if self.game_over and self.ended is None:
+            self.ended = datetime.utcnow()
+
+    @classmethod
+    def get_game(cls, urlsafe_key):
+        """Returns the Game a urlsafe key points to, or None. Games that were
+        compacted into an ArchivedGame are rebuilt from it, read only. The
+        game and its archive are fetched in one batch"""
+        key = get_key_by_urlsafe(urlsafe_key, cls)
+        game, archive = ndb.get_multi([key, ArchivedGame.key_for(key)])
+        if game is None and archive is not None:
+            game = archive.to_game(key)
+        return game
+
+    def is_valid_move(self, move):
+        """Returns True if the move is a cell on the board"""
+        return 0 <= move < self.boardSize * self.boardSize
+
+    def is_free(self, move):
+        """Returns True if nobody has played the cell yet"""
+        return self.engine.is_empty(move)
+
+    def play(self, move, mark):
+        """Plays a mark, records it in the game history and hands the turn
+        over. Returns True if the move wins the game"""
+        won = self.engine.play(move, mark)
+        self.game_history.append((mark, move))
+        self.nextMove = self.player_o if mark == X else self.player_x
+        return won
+
+    def is_full(self):
+        """Returns True if the board is full"""
+        return self.engine.is_full()
+
+    @property
+    def next_mark(self):
+        """Returns the mark of the player whose turn it is. X moves first"""
+        return X if len(self.game_history) % 2 == 0 else O
+
+    @property
+    def vs_computer(self):
+        """Returns True if the computer plays O in this game"""
+        return self.player_o == User.computer_key()
+
+    def take_turn(self, move):
+        """Plays move for the player whose turn it is and ends the game if
+        that wins or fills the board. Returns the entities to put"""
+        mark = self.next_mark
+        if self.play(move, mark):
+            return self.end_game(self.player_x if mark == X else self.player_o)
+        if self.is_full():
+            # game ends in a draw
+            return self.end_game()
+        return [self]
+
+    @property
+    def user_keys(self):
+        """Returns the keys of every User the GameForm names"""
+        return [self.player_x, self.player_o, self.nextMove, self.winner]
+
+    @classmethod
+    def to_forms(cls, games):
+        """Returns a GameForms for the games, resolving every User named in
+        them with a single get_multi"""
+        games = list(games)
+        names = get_names(key for game in games for key in game.user_keys)
+        return GameForms(items=[game.to_form(names) for game in games])
+
+    def to_form(self, names=None):
+        """Returns a GameForm representation of the Game. names maps User
+        keys to names; it is fetched for this game alone when not given"""
+        if names is None:
+            names = get_names(self.user_keys)
         form = GameForm(urlsafe_key = self.key.urlsafe(),
-                        board = str(self.board),
+                        board = str(self.engine.cells()),
                         boardSize = self.boardSize,
-                        player_x = self.player_x.get().name,
-                        player_o = self.player_o.get().name,
-                        nextMove = self.nextMove.get().name,
-                        game_over = self.game_over
+                        win_length = self.engine.win_length,
+                        player_x = names.get(self.player_x),
+                        player_o = names.get(self.player_o),
+                        nextMove = names.get(self.nextMove),
+                        game_over = self.game_over,
+                        version = self.version
                         )
         if self.winner:
             # send winner to Game form and get winner's name
-            form.winner = self.winner.get().name
+            form.winner = names.get(self.winner)
         if self.draw:
             form.draw = self.draw
         return form
 
-    def end_game( self, winner=False):
-        """Ends the game - if winner is True, the player won. - if winner is False,
-        the player match is draw, or player lost."""
+    @ndb.tasklet
+    def to_form_async(self):
+        """Like to_form, returning a Future for the GameForm"""
+        names = yield get_names_async(self.user_keys)
+        raise ndb.Return(self.to_form(names))
+
+    def to_delta_form(self, since_version):
+        """Returns a GameDeltaForm holding the moves played after
+        since_version and the game's current state"""
+        if since_version >= self.version:
+            return GameDeltaForm(version=self.version, modified=False)
+        names = get_names([self.nextMove, self.winner])
+        form = GameDeltaForm(version=self.version,
+                             modified=True,
+                             moves=[MoveForm(mark=mark, move=move)
+                                    for mark, move in
+                                    self.game_history[since_version:]],
+                             nextMove=names.get(self.nextMove),
+                             game_over=self.game_over)
+        if self.winner:
+            form.winner = names.get(self.winner)
+        if self.draw:
+            form.draw = self.draw
+        return form
+
+    @staticmethod
+    def cached_version(urlsafe_key):
+        """Returns the game's version from memcache, or None"""
+        return memcache.get(MEMCACHE_GAME_VERSION % urlsafe_key)
+
+    def cache_version(self):
+        """Publishes the game's version in memcache. The cached version only
+        moves forward, however the writes of concurrent requests interleave"""
+        self.cache_version_async().get_result()
+
+    @ndb.tasklet
+    def cache_version_async(self):
+        """Like cache_version, returning a Future"""
+        ctx = ndb.get_context()
+        cache_key = MEMCACHE_GAME_VERSION % self.key.urlsafe()
+        for _ in range(3):
+            cached = yield ctx.memcache_gets(cache_key)
+            if cached is None:
+                if (yield ctx.memcache_add(cache_key, self.version)):
+                    return
+            elif (cached >= self.version or
+                  (yield ctx.memcache_cas(cache_key, self.version))):
+                return
+
+    @staticmethod
+    def cached_form(urlsafe_key):
+        """Returns the game's GameForm if one rendered at the game's current
+        version is cached, or None. A form this instance already holds only
+        costs a memcache get of the version"""
+        version_key = MEMCACHE_GAME_VERSION % urlsafe_key
+        form_key = MEMCACHE_GAME_FORM % urlsafe_key
+        local = _game_forms.get(urlsafe_key)
+        if local:
+            if local[0] == memcache.get(version_key):
+                return protojson.decode_message(GameForm, local[1])
+        cached = memcache.get_multi([version_key, form_key])
+        version = cached.get(version_key)
+        entry = cached.get(form_key)
+        if version is None or entry is None or entry[0] != version:
+            return None
+        _game_forms.set(urlsafe_key, entry)
+        return protojson.decode_message(GameForm, entry[1])
+
+    def cache_form(self, form):
+        """Caches the game's GameForm for its current version and publishes
+        the version"""
+        self.cache_form_async(form).get_result()
+
+    @ndb.tasklet
+    def cache_form_async(self, form):
+        """Like cache_form, returning a Future. The form and version are
+        written in parallel: until both land, readers see a version mismatch
+        and render the game themselves"""
+        urlsafe_key = self.key.urlsafe()
+        entry = (self.version, protojson.encode_message(form))
+        _game_forms.set(urlsafe_key, entry)
+        yield (ndb.get_context().memcache_set(MEMCACHE_GAME_FORM % urlsafe_key,
+                                              entry,
+                                              time=GAME_FORM_CACHE_TIME),
+               self.cache_version_async())
+
+    def uncache(self):
+        """Drops the game's version and GameForm from the caches"""
+        urlsafe_key = self.key.urlsafe()
+        _game_forms.delete(urlsafe_key)
+        memcache.delete_multi([MEMCACHE_GAME_VERSION % urlsafe_key,
+                               MEMCACHE_GAME_FORM % urlsafe_key])
+
+    def finish(self, winner=False):
+        """Marks the game over, won by winner or drawn. Returns its new,
+        unsaved Score"""
         self.game_over = True
         if winner:
             self.winner = winner
         else:
             self.draw = True
-        self.put()
         if winner:
             result = 'player_x' if winner == self.player_x else 'player_o'
         else:
             result = 'draw'
 
         # Add the game to the score 'board'
-        score = Score(player_x = self.player_x,
-                      player_o = self.player_o,
-                      date=date.today(),
-                      result = result
-                      )
-        score.put()
-
-        # Update the User's stats model
+        return Score(player_x = self.player_x,
+                     player_o = self.player_o,
+                     date=date.today(),
+                     result = result
+                     )
+
+    def end_game(self, winner=False):
+        """Ends the game - if winner is True, the player won. - if winner is False,
+        the player match is draw, or player lost. Nothing is written: returns
+        the Game, its new Score and the players' Users for the caller to put
+        together. The computer's stats are not kept"""
+        score = self.finish(winner)
+
+        # Update the User's stats model. The players are fetched while the
+        # counter shard is read
+        keys = [key for key in set([self.player_x, self.player_o])
+                if key != User.computer_key()]
+        fetching = ndb.get_multi_async(keys)
+        counter = GameCounter.count_game(self.draw)
+        players = dict(zip(keys, [f.get_result() for f in fetching]))
         if winner:
-            winner.get().user_win()
             loser = self.player_x if winner == self.player_o else self.player_o
-            loser.get().user_loss()
+            results = ((winner, User.user_win), (loser, User.user_loss))
         else:
-            self.player_x.get().user_draw()
-            self.player_o.get().user_draw()
+            results = ((self.player_x, User.user_draw),
+                       (self.player_o, User.user_draw))
+        for key, result in results:
+            if key in keys:
+                result(players[key])
+        return [self, score, counter] + [players[key] for key in keys]
+
+
+class ArchivedGame(ndb.Model):
+    """A finished Game compacted for long term storage. It is keyed by the
+    id of the Game it replaces and keeps only the packed move log, from which
+    the board is replayed, plus what a GameForm needs. Only players and ended
+    are indexed, so a User's archive is one index scan"""
+    boardSize = ndb.IntegerProperty     (required=True, indexed=False)
+    win_length = ndb.IntegerProperty    (indexed=False)
+    game_history = MoveLogProperty      (required=True)
+    player_x = ndb.KeyProperty          (required=True, kind='User',
+                                         indexed=False)
+    player_o = ndb.KeyProperty          (required=True, kind='User',
+                                         indexed=False)
+    nextMove = ndb.KeyProperty          (indexed=False)
+    winner = ndb.KeyProperty            (indexed=False)
+    draw = ndb.BooleanProperty          (default=False, indexed=False)
+    players = ndb.KeyProperty           (kind='User', repeated=True)
+    created = ndb.DateTimeProperty      (indexed=False)
+    ended = ndb.DateTimeProperty        ()
+
+    @classmethod
+    def key_for(cls, game_key):
+        """Returns the key an archived Game is stored under"""
+        return ndb.Key(cls, game_key.id())
+
+    @classmethod
+    def from_game(cls, game):
+        """Returns an unsaved archive of a finished Game"""
+        return cls(key=cls.key_for(game.key),
+                   boardSize=game.boardSize,
+                   win_length=game.engine.win_length,
+                   game_history=game.game_history,
+                   player_x=game.player_x,
+                   player_o=game.player_o,
+                   nextMove=game.nextMove,
+                   winner=game.winner,
+                   draw=game.draw,
+                   players=[game.player_x, game.player_o],
+                   created=game.created,
+                   ended=game.ended)
 
+    def to_game(self, game_key):
+        """Rebuilds the Game in memory by replaying its moves. The result
+        must not be put back"""
+        board = Board(self.boardSize, self.win_length)
+        for mark, move in self.game_history:
+            board.place(move, mark)
+        return Game(key=game_key,
+                    board=board,
+                    boardSize=self.boardSize,
+                    win_length=self.win_length,
+                    player_x=self.player_x,
+                    player_o=self.player_o,
+                    nextMove=self.nextMove,
+                    winner=self.winner,
+                    draw=self.draw,
+                    game_over=True,
+                    game_history=self.game_history,
+                    created=self.created,
+                    ended=self.ended)
 
 
 class Score(ndb.Model):
@@ -154,9 +678,128 @@ class Score(ndb.Model):
     player_x = ndb.KeyProperty(required=True, kind = 'User')
     player_o = ndb.KeyProperty(required=True, kind = 'User')
     result = ndb.StringProperty(required=True)
+    # Both players, so a User's scores are one index scan
+    players = ndb.KeyProperty(kind = 'User', repeated=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
 
-    def to_form(self):
+    def _pre_put_hook(self):
+        """Keeps players in step with player_x and player_o"""
+        self.players = [self.player_x, self.player_o]
+
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns a ScoreForms for the scores, resolving every User named in
+        them with a single get_multi"""
+        scores = list(scores)
+        names = get_names(key for score in scores
+                          for key in (score.player_x, score.player_o))
+        return ScoreForms(items=[score.to_form(names) for score in scores])
+
+    def to_form(self, names=None):
+        if names is None:
+            names = get_names([self.player_x, self.player_o])
         return ScoreForm(date=str(self.date),
-                         player_x=self.player_x.get().name,
-                         player_o=self.player_o.get().name,
-                         result=self.result)
\ No newline at end of file
+                         player_x=names.get(self.player_x),
+                         player_o=names.get(self.player_o),
+                         result=self.result)
+
+
+class GameCounter(ndb.Model):
+    """One shard of the finished game counters. A finished game updates a
+    random shard so concurrent games rarely contend; totals are the sum of
+    every shard and are cached in memcache"""
+    NUM_SHARDS = 20
+    COUNTERS = ('games_finished', 'wins', 'draws')
+    # Cached totals expire so any increment lost to a race is corrected
+    CACHE_TIME = 600
+
+    games_finished = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    draws = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def shard_keys(cls):
+        return [ndb.Key(cls, 'shard-%d' % i) for i in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    def count_game(cls, draw):
+        """Adds a finished game to a random shard and returns the shard for
+        the caller to put, within the transaction that ends the game"""
+        return cls.count_games(0 if draw else 1, 1 if draw else 0)
+
+    @classmethod
+    def count_games(cls, wins, draws):
+        """Adds finished games to a random shard and returns the shard for
+        the caller to put, within a transaction"""
+        key = random.choice(cls.shard_keys())
+        shard = key.get() or cls(key=key)
+        shard.games_finished += wins + draws
+        shard.wins += wins
+        shard.draws += draws
+        return shard
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def add_games(cls, wins, draws, log_key):
+        """Adds finished games to a random shard, unless log_key shows they
+        were added already. Returns True if they were added"""
+        if log_key.get():
+            return False
+        ndb.put_multi([cls.count_games(wins, draws), ImportLog(key=log_key)])
+        return True
+
+    @classmethod
+    def cache_games(cls, wins, draws):
+        """Counts many committed games in the cached totals"""
+        memcache.offset_multi({'games_finished': wins + draws,
+                               'wins': wins,
+                               'draws': draws},
+                              key_prefix=MEMCACHE_GAME_COUNTERS)
+
+    @classmethod
+    @ndb.tasklet
+    def cache_game_async(cls, draw):
+        """Counts a committed game in the cached totals, returning a Future.
+        Totals that are not cached are left alone and summed from the shards
+        on the next read. ndb batches the increments into one offset_multi"""
+        ctx = ndb.get_context()
+        yield [ctx.memcache_incr(MEMCACHE_GAME_COUNTERS + name)
+               for name in ('games_finished', 'draws' if draw else 'wins')]
+
+    @classmethod
+    def totals(cls):
+        """Returns a dict of each counter's total, from memcache when cached"""
+        totals = memcache.get_multi(cls.COUNTERS,
+                                    key_prefix=MEMCACHE_GAME_COUNTERS)
+        if len(totals) < len(cls.COUNTERS):
+            totals = cls.cache_totals()
+        return totals
+
+    @classmethod
+    def cache_totals(cls):
+        """Sums the shards into memcache and returns the totals"""
+        totals = dict((name, 0) for name in cls.COUNTERS)
+        for shard in ndb.get_multi(cls.shard_keys()):
+            if shard:
+                for name in cls.COUNTERS:
+                    totals[name] += getattr(shard, name)
+        memcache.set_multi(totals, time=cls.CACHE_TIME,
+                           key_prefix=MEMCACHE_GAME_COUNTERS)
+        return totals
+
+    @classmethod
+    def to_form(cls):
+        return GameStatsForm(**cls.totals())
+
+
+class ImportLog(ndb.Model):
+    """Logs a step of a games import as done, so that a retry of the import
+    skips it. Keyed by the client's import id, alone once the whole import
+    is done, or followed by the step"""
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, import_id, step=None):
+        if step is None:
+            return ndb.Key(cls, import_id)
+        return ndb.Key(cls, '%s:%s' % (import_id, step))
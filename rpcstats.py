@@ -0,0 +1,126 @@
+"""rpcstats.py - Counts the App Engine API calls a request makes.
+
+install() adds hooks to the API proxy that count every datastore, memcache
+and taskqueue RPC made on a thread while it is recording. Recording is per
+thread, so concurrent requests on a threadsafe instance are kept apart, and
+recordings nest: an RPC counts towards every recording active on its thread.
+
+    stats = rpcstats.start()
+    ... handle the request ...
+    rpcstats.stop()
+    stats.datastore_gets, stats.memcache_hits, stats.trace
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+_local = threading.local()
+_installed = set()
+
+
+class RpcStats(object):
+    """RPCs made while recording. counts maps 'service.Call' to the number
+    of calls; trace, when kept, lists (service, call, start, duration) with
+    times in seconds from the start of recording"""
+
+    def __init__(self, keep_trace=False):
+        self.counts = collections.defaultdict(int)
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+        self.trace = [] if keep_trace else None
+        self.started = time.time()
+        self._pending = {}
+
+    def count(self, *calls):
+        """Returns the number of calls made to any of 'service.Call'"""
+        return sum(self.counts.get(call, 0) for call in calls)
+
+    @property
+    def datastore_gets(self):
+        return self.count('datastore_v3.Get')
+
+    @property
+    def datastore_puts(self):
+        return self.count('datastore_v3.Put')
+
+    @property
+    def datastore_queries(self):
+        return self.count('datastore_v3.RunQuery', 'datastore_v3.Next')
+
+    @property
+    def datastore_rpcs(self):
+        return sum(n for call, n in self.counts.iteritems()
+                   if call.startswith('datastore_v3.'))
+
+    @property
+    def memcache_rpcs(self):
+        return sum(n for call, n in self.counts.iteritems()
+                   if call.startswith('memcache.'))
+
+    @property
+    def taskqueue_adds(self):
+        return self.count('taskqueue.Add', 'taskqueue.BulkAdd')
+
+    def _pre_call(self, service, call, rpc):
+        self.counts['%s.%s' % (service, call)] += 1
+        if self.trace is not None:
+            self._pending[id(rpc)] = time.time()
+
+    def _post_call(self, service, call, request, response, rpc):
+        if service == 'memcache' and call == 'Get':
+            hits = response.item_size()
+            self.memcache_hits += hits
+            self.memcache_misses += request.key_size() - hits
+        if self.trace is not None:
+            start = self._pending.pop(id(rpc), None)
+            if start is not None:
+                self.trace.append((service, call, start - self.started,
+                                   time.time() - start))
+
+
+def _recording():
+    """Returns the current thread's active recordings, innermost last"""
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _pre_call_hook(service, call, request, response, rpc=None):
+    for stats in _recording():
+        stats._pre_call(service, call, rpc)
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    if error is None:
+        for stats in _recording():
+            stats._post_call(service, call, request, response, rpc)
+
+
+def install():
+    """Adds the counting hooks to the current API proxy, once"""
+    proxy = apiproxy_stub_map.apiproxy
+    if id(proxy) in _installed:
+        return
+    proxy.GetPreCallHooks().Append('rpcstats', _pre_call_hook)
+    proxy.GetPostCallHooks().Append('rpcstats', _post_call_hook)
+    _installed.add(id(proxy))
+
+
+def start(keep_trace=False):
+    """Starts recording the current thread's RPCs. Returns the RpcStats
+    they are counted in"""
+    install()
+    stats = RpcStats(keep_trace)
+    _recording().append(stats)
+    return stats
+
+
+def stop():
+    """Stops the innermost recording on the current thread. Returns its
+    RpcStats, or None if nothing was recording"""
+    stack = _recording()
+    return stack.pop() if stack else None
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""startup_benchmark.py - Reports the import time of each module a new
+instance loads, so cold start cost is tracked. Each entry module is imported
+in a fresh interpreter with __import__ timed. A module's own time excludes
+the imports it triggered, while its total includes them. With --warmup, the
+steps of warmup.warm() are also timed against in-memory App Engine stubs.
+Needs the App Engine SDK on the path, e.g.
+
+    python startup_benchmark.py --top 15 --warmup
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+ENTRY_MODULES = ('TTTAPI', 'main')
+
+
+def profile_imports(module):
+    """Imports module, timing every import it triggers. Returns the seconds
+    the import took and a dict of module name to (total seconds, own
+    seconds)"""
+    import __builtin__
+    original = __builtin__.__import__
+    timings = {}
+    # Seconds spent in the nested imports of each import in progress
+    nested = []
+
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return original(name, *args, **kwargs)
+        nested.append(0.0)
+        start = time.time()
+        try:
+            return original(name, *args, **kwargs)
+        finally:
+            total = time.time() - start
+            own = total - nested.pop()
+            if nested:
+                nested[-1] += total
+            if total > timings.get(name, (0, 0))[0]:
+                timings[name] = (total, own)
+
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    try:
+        timed_import(module)
+    finally:
+        __builtin__.__import__ = original
+    return time.time() - start, timings
+
+
+def time_warmup():
+    """Runs warmup.warm() against in-memory stubs. Returns its timings"""
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    try:
+        import warmup
+        return warmup.warm()
+    finally:
+        bed.deactivate()
+
+
+def run_child(args):
+    """Runs a measurement in a fresh interpreter and returns its result"""
+    output = subprocess.check_output([sys.executable, __file__] + args)
+    return json.loads(output)
+
+
+def show_imports(module, seconds, timings, top):
+    rows = sorted(timings.iteritems(), key=lambda row: -row[1][1])
+    print '%s: %.1fms' % (module, seconds * 1000)
+    print '  %-44s%10s%10s' % ('module', 'own ms', 'total ms')
+    for name, (total, own) in rows[:top]:
+        print '  %-44s%10.1f%10.1f' % (name, own * 1000, total * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('modules', nargs='*', default=list(ENTRY_MODULES),
+                        help='entry modules to import cold')
+    parser.add_argument('--top', type=int, default=15,
+                        help='modules to list, slowest first')
+    parser.add_argument('--warmup', action='store_true',
+                        help='also time the warmup steps')
+    parser.add_argument('--child-import', help=argparse.SUPPRESS)
+    parser.add_argument('--child-warmup', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_import:
+        print json.dumps(profile_imports(args.child_import))
+        return
+    if args.child_warmup:
+        print json.dumps(time_warmup())
+        return
+
+    for module in args.modules:
+        seconds, timings = run_child(['--child-import', module])
+        show_imports(module, seconds, timings, args.top)
+        print
+    if args.warmup:
+        print 'warmup'
+        for step, seconds in run_child(['--child-warmup']):
+            print '  %-44s%10.1f' % (step, seconds * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""test_encoding.py - Round trips of the compact board and move log encoding,
+and reads of the pickled values stored before it. Needs the App Engine SDK
+on the path, e.g.
+
+    python -m unittest test_encoding
+"""
+
+import pickle
+import random
+import unittest
+
+from board import (Board, X, O, MIN_BOARD_SIZE, MAX_BOARD_SIZE,
+                   default_win_length, encode_board, decode_board,
+                   encode_moves, decode_moves, is_encoded)
+from models import BoardProperty, MoveLogProperty, Game
+
+
+def random_moves(size, rand):
+    """Returns every cell of a board in a random order, as (mark, cell)
+    tuples played in turn from X"""
+    cells = range(size * size)
+    rand.shuffle(cells)
+    return [(X if i % 2 == 0 else O, cell) for i, cell in enumerate(cells)]
+
+
+class BoardEncodingTest(unittest.TestCase):
+
+    def test_board_round_trip(self):
+        rand = random.Random(0)
+        for size in range(MIN_BOARD_SIZE, MAX_BOARD_SIZE + 1):
+            board = Board(size, default_win_length(size))
+            # Every fill level, including empty and full
+            for mark, cell in [(None, None)] + random_moves(size, rand):
+                if mark:
+                    board.place(cell, mark)
+                decoded = decode_board(encode_board(board))
+                self.assertEqual(decoded.size, size)
+                self.assertEqual(decoded.win_length, board.win_length)
+                self.assertEqual((decoded.x, decoded.o), (board.x, board.o))
+
+    def test_moves_round_trip(self):
+        rand = random.Random(0)
+        for size in range(MIN_BOARD_SIZE, MAX_BOARD_SIZE + 1):
+            moves = random_moves(size, rand)
+            for count in (0, 1, len(moves)):
+                self.assertEqual(decode_moves(encode_moves(moves[:count])),
+                                 moves[:count])
+
+    def test_large_cells_use_varints(self):
+        moves = [(X, 127), (O, 128), (X, 360)]
+        self.assertEqual(len(encode_moves(moves)), 1 + 1 + 2 + 2)
+        self.assertEqual(decode_moves(encode_moves(moves)), moves)
+
+    def test_pickles_are_not_encoded(self):
+        for protocol in (0, 2):
+            self.assertFalse(is_encoded(pickle.dumps(['', X, O], protocol)))
+            self.assertFalse(is_encoded(pickle.dumps([(X, 4)], protocol)))
+        self.assertFalse(is_encoded(''))
+        self.assertTrue(is_encoded(encode_board(Board(3))))
+        self.assertTrue(is_encoded(encode_moves([])))
+
+
+class LegacyPropertyTest(unittest.TestCase):
+
+    def test_board_property_round_trip(self):
+        prop = BoardProperty()
+        board = Board(15, 5)
+        board.place(0, X)
+        board.place(224, O)
+        decoded = prop._from_base_type(prop._to_base_type(board))
+        self.assertEqual((decoded.size, decoded.win_length), (15, 5))
+        self.assertEqual(decoded.occupied(), {0: X, 224: O})
+
+    def test_move_log_property_round_trip(self):
+        prop = MoveLogProperty()
+        moves = [(X, 4), (O, 0), (X, 8)]
+        self.assertEqual(prop._from_base_type(prop._to_base_type(moves)),
+                         moves)
+
+    def test_legacy_board_list(self):
+        cells = ['X', 'O', '', '', 'X', '', '', '', 'O']
+        for protocol in (0, 2):
+            value = BoardProperty()._from_base_type(
+                pickle.dumps(cells, protocol))
+            self.assertEqual(value, cells)
+            game = Game(board=value, boardSize=3)
+            self.assertTrue(game.is_legacy)
+            self.assertEqual(game.engine.cells(), cells)
+            self.assertFalse(game.is_legacy)
+
+    def test_legacy_board_dict(self):
+        occupied = {0: X, 12: O, 24: X}
+        for protocol in (0, 2):
+            value = BoardProperty()._from_base_type(
+                pickle.dumps(occupied, protocol))
+            self.assertEqual(value, occupied)
+            game = Game(board=value, boardSize=5, win_length=4)
+            self.assertEqual(game.engine.occupied(), occupied)
+            self.assertEqual(game.engine.win_length, 4)
+
+    def test_legacy_board_wins_with_a_full_row(self):
+        game = Game(board=['X', 'X', '', '', '', '', '', '', ''],
+                    boardSize=3)
+        self.assertEqual(game.engine.win_length, 3)
+        self.assertTrue(game.engine.play(2, X))
+
+    def test_legacy_move_log(self):
+        history = [('X', 4), ('O', 0), ('X', 8)]
+        for protocol in (0, 2):
+            self.assertEqual(MoveLogProperty()._from_base_type(
+                pickle.dumps(history, protocol)), history)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,14 @@
 """utils.py - File for collecting general utility functions."""
 
+import collections
+import threading
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-import endpoints
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
@@ -16,52 +23,115 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
+    entity = get_key_by_urlsafe(urlsafe, model).get()
+    if not entity:
+        return None
+    if not isinstance(entity, model):
+        raise ValueError('Incorrect Kind')
+    return entity
+
+
+def _bad_request(message):
+    """Returns an endpoints BadRequestException. endpoints is imported here
+    so that task handlers, which import utils through models, do not load
+    it"""
+    import endpoints
+    return endpoints.BadRequestException(message)
+
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string points to, without
+        fetching the entity.
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The ndb.Key the urlsafe Key string encodes.
+    Raises:
+        BadRequestException: If the key String is malformed
+        ValueError: If the key is of the incorrect kind"""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
+        raise _bad_request('Invalid Key')
     except Exception, e:
         if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
+            raise _bad_request('Invalid Key')
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
+
+
+def get_names(keys):
+    """Returns a dict mapping each key to the name of the entity it points to.
+    All the keys are fetched with one get_multi, and empty keys are skipped"""
+    return get_names_async(keys).get_result()
+
+
+@ndb.tasklet
+def get_names_async(keys):
+    """Like get_names, returning a Future for the dict"""
+    keys = list(set(key for key in keys if key))
+    entities = yield ndb.get_multi_async(keys)
+    raise ndb.Return(dict((key, entity.name)
+                          for key, entity in zip(keys, entities) if entity))
+
+
+def fetch_page(query, page_size=None, cursor=None):
+    """Fetches one page of a query.
+    Args:
+        query: The ndb.Query to run
+        page_size: Requested number of results, capped at MAX_PAGE_SIZE
+        cursor: urlsafe cursor returned with the previous page, if any
+    Returns:
+        A (results, next_cursor) tuple. next_cursor is the urlsafe cursor for
+        the following page or None on the last page.
+    Raises:
+        BadRequestException: If the page size or cursor is invalid"""
+    page_size = page_size or DEFAULT_PAGE_SIZE
+    if not 0 < page_size <= MAX_PAGE_SIZE:
+        raise _bad_request(
+            'Page size must be between 1 and %d' % MAX_PAGE_SIZE)
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except datastore_errors.BadValueError:
+        raise _bad_request('Invalid cursor')
+    results, next_cursor, more = query.fetch_page(page_size,
+                                                  start_cursor=start_cursor)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+class LRUCache(object):
+    """A bounded, thread safe least recently used cache, shared by every
+    request an instance serves"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None, and marks it recently used"""
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        """Caches a value, evicting the least recently used one if full"""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
 
-def check_winner(board, size=3):
-    """Check the board. If there is a winner, return the symbol of the winner"""
-    # Check rows
-    for i in range(size):
-        if board[size * i]:
-            if all_same(board[size * i:size * i + size]):
-                return board[size * i]
-    # Check columns
-    for i in range(size):
-        if board[i]:
-            if all_same(board[i:size * size:size]):
-                return board[i]
-    # Check diagonals
-    if board[0]:
-        if all_same(board[0:size * size:size + 1]):
-            return board[0]
-    if board[size - 1]:
-        if all_same(board[size - 1:size * (size - 1) + 1:size - 1]):
-            return board[size - 1]
-
-
-def check_full(board):
-    """Return true if the board is full"""
-    for cell in board:
-        if not cell:
-            return False
-    return True
-
-
-def all_same(items):
-    """Check if all items in list have the same value."""
-    return all(x == items[0] for x in items)
\ No newline at end of file
+    def delete(self, key):
+        """Drops a value from the cache"""
+        with self._lock:
+            self._items.pop(key, None)
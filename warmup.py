@@ -0,0 +1,57 @@
+"""warmup.py - Gets a new instance ready before it serves traffic.
+
+With warmup enabled in app.yaml, App Engine sends /_ah/warmup to each new
+instance before routing requests to it. warm() imports the API, so that
+endpoints, protorpc, the models, the messages and the API config are loaded
+once, up front. It then fills the per instance tables of the board engine
+and the computer opponent, and primes the memcache keys the hot endpoints
+read. A step that fails is logged and skipped: the instance only starts
+colder."""
+
+import logging
+import time
+
+
+def load_api():
+    """Imports the endpoint module and everything it depends on"""
+    import TTTAPI
+
+
+def build_board_tables():
+    """Builds the line masks of every board size at its default win length"""
+    from board import (MIN_BOARD_SIZE, MAX_BOARD_SIZE, default_win_length,
+                       line_masks)
+    for size in range(MIN_BOARD_SIZE, MAX_BOARD_SIZE + 1):
+        line_masks(size, default_win_length(size))
+
+
+def solve_3x3():
+    """Solves the classic game for the computer opponent"""
+    import ai
+    ai.solve()
+
+
+def prime_memcache():
+    """Caches the finished game totals and the first page of the rankings,
+    unless they already are"""
+    from TTTAPI import TicTacToeApi
+    from models import GameCounter
+    from utils import DEFAULT_PAGE_SIZE
+    GameCounter.totals()
+    TicTacToeApi._rankings_page(DEFAULT_PAGE_SIZE)
+
+
+STEPS = (load_api, build_board_tables, solve_3x3, prime_memcache)
+
+
+def warm():
+    """Runs every warmup step. Returns a list of (step name, seconds)"""
+    timings = []
+    for step in STEPS:
+        start = time.time()
+        try:
+            step()
+        except Exception:
+            logging.exception('Warmup step %s failed', step.__name__)
+        timings.append((step.__name__, time.time() - start))
+    return timings